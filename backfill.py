@@ -0,0 +1,217 @@
+import importlib
+from pathlib import Path
+
+from dateutil import parser
+
+from fetching import FETCH_MAX_WORKERS, Fetcher
+from state import load_state, save_state
+from utils import setup_logging
+
+
+# set constants
+# -------------
+
+# sources with paginated listings; each provides `get_listing_url(page)`
+# and either `scrape_listing(response)` with `scrape_subpage(url, response)`
+# or, without subpages, `scrape_entries(response)`
+BACKFILL_SOURCES = [
+    "hrvatska_posta",
+    "kd_pag",
+    "komunalac_bnm",
+    "liburnija_zadar",
+    "vo_sibenik",
+]
+# sources whose entries have a publish date, so a backfill can stop
+# at `since`; the others' notices aren't dated
+BACKFILL_DATED_SOURCES = [
+    "kd_pag",
+    "liburnija_zadar",
+    "vo_sibenik",
+]
+BACKFILL_MAX_PAGES = 100
+# listing pages downloaded at the same time
+BACKFILL_BATCH = FETCH_MAX_WORKERS
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)' \
+                  'Gecko/20100101 Firefox/53.0'
+}
+
+
+# archive
+# -------
+
+class BackfillArchive:
+    """
+    Entries found by a source's backfill, archived in a file per listing
+    page under `<source>/data/backfill/`. Archived pages are also the
+    backfill's progress: a stopped backfill skips them when run again.
+    """
+    def __init__(self, source):
+        self.path = Path(f"{source}/data/backfill")
+        self.pages = set()
+        self.links = set()
+        for path in self.path.glob("page_*.json"):
+            self.pages.add(int(path.stem.partition("_")[2]))
+            self.links.update(entry["link"] for entry in load_state(path, []))
+
+    def add(self, page, entries):
+        save_state(self.path / f"page_{page:05d}.json", entries)
+        self.pages.add(page)
+        self.links.update(entry["link"] for entry in entries)
+
+
+# backfilling
+# -----------
+
+def get_published_at(entry):
+    try:
+        published_at = parser.parse(entry.get("published_at"), dayfirst=True)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return published_at.replace(tzinfo=None)
+
+
+def scrape_pages(module, fetcher, pages, listed):
+    """
+    Downloads listing pages and returns (page, links, entries) tuples of
+    the pages in order, up to the end of the listing; entries are None
+    for sources with subpages.
+    """
+    urls = {module.get_listing_url(page): page for page in pages}
+    responses = dict(fetcher.make_requests(list(urls)))
+
+    scraped = []
+    for url, page in urls.items():
+        # past the last page, or a page that failed to download
+        if url not in responses:
+            break
+        try:
+            if hasattr(module, "scrape_entries"):
+                entries = module.scrape_entries(responses[url])
+                links = [entry.get("link") for entry in entries]
+            else:
+                entries = None
+                links = [link for link, _ in module.scrape_listing(
+                    responses[url]
+                )]
+        except:
+            module.logger.error(f"Error scraping listing page: {url}")
+            break
+
+        # sites that ignore an unknown page repeat the last or first page
+        if not links or all(link in listed for link in links):
+            break
+        listed.update(links)
+        scraped.append((page, list(dict.fromkeys(links)), entries))
+
+    return scraped
+
+
+def backfill(source, max_pages=BACKFILL_MAX_PAGES, since=None, budget=None):
+    """
+    Walks a source's paginated listing back to `max_pages` pages, or to
+    the first page with entries published before `since`, and archives
+    the entries found. Nothing is matched or mailed, and the source's
+    results, seen links and HTTP cache are left alone.
+
+    Pages and subpages are downloaded concurrently within the fetching
+    limits. A listing page that can't be downloaded ends the walk, and a
+    page with subpages that failed isn't archived, so running the
+    backfill again resumes it.
+
+    - Input:
+    source: one of BACKFILL_SOURCES
+    max_pages: number of listing pages to walk
+    since: optional datetime, for BACKFILL_DATED_SOURCES; undated
+    entries don't stop the walk
+    budget: optional seconds the backfill may spend downloading
+
+    Returns the number of archived entries.
+    """
+    if since and source not in BACKFILL_DATED_SOURCES:
+        raise ValueError(f"Entries of {source} aren't dated")
+
+    module = importlib.import_module(source)
+    setup_logging(module.logger, module.LOG_PATH, module.JOB_ID)
+
+    # pages are needed even when not modified since the last regular run
+    fetcher = Fetcher(
+        module.logger, HEADERS, budget=budget or float("inf")
+    )
+    archive = BackfillArchive(source)
+    # links of this and previous backfills
+    listed = set(archive.links)
+    archived = 0
+
+    page = 1
+    done = False
+    while not done and page <= max_pages:
+        pages = [
+            p for p in range(page, min(page + BACKFILL_BATCH, max_pages + 1))
+            if p not in archive.pages
+        ]
+        page += BACKFILL_BATCH
+        if not pages:
+            continue
+
+        scraped = scrape_pages(module, fetcher, pages, listed)
+        # the listing ended within the batch
+        done = len(scraped) < len(pages)
+
+        # scrape subpages of all pages in the batch at once
+        if not hasattr(module, "scrape_entries"):
+            urls = [
+                link for _, links, _ in scraped for link in links
+                if link not in archive.links
+            ]
+            subpages = dict()
+            for url, response in fetcher.make_requests(urls):
+                try:
+                    subpages[url] = module.scrape_subpage(url, response)
+                except:
+                    module.logger.error(f"Error scraping subpage: {url}")
+
+        for p, links, entries in scraped:
+            if entries is None:
+                missing = [
+                    link for link in links
+                    if link not in subpages and link not in archive.links
+                ]
+                if missing:
+                    module.logger.warning(
+                        f"Listing page {p} not archived: {len(missing)} "
+                        f"subpages failed, retried on the next backfill"
+                    )
+                    continue
+                entries = [
+                    subpages[link] for link in links if link in subpages
+                ]
+            else:
+                entries = [
+                    entry for entry in entries
+                    if entry.get("link") not in archive.links
+                ]
+
+            # listings are sorted newest first, so older pages only
+            # have older entries
+            reached_since = False
+            if since:
+                dates = [get_published_at(entry) for entry in entries]
+                reached_since = any(date and date < since for date in dates)
+                entries = [
+                    entry for entry, date in zip(entries, dates)
+                    if not date or date >= since
+                ]
+
+            archive.add(p, entries)
+            archived += len(entries)
+            if reached_since:
+                done = True
+                break
+
+    fetcher.commit()
+    module.logger.info(
+        f"Backfill: {archived} entries archived in {archive.path}, "
+        f"{len(archive.pages)} listing pages in total"
+    )
+    return archived
@@ -0,0 +1,139 @@
+import argparse
+import importlib
+import json
+import timeit
+import tracemalloc
+from datetime import date
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from fetching import SSL_CONTEXT, UNVERIFIED_SSL_CONTEXT, send_request
+
+
+# set constants
+# -------------
+
+# source: (listing page URL, strainer name)
+LISTINGS = {
+    "hak": ("SOURCE_URL_MARITIME", "PARSE_ONLY"),
+    "hep": ("SOURCE_URL", "PARSE_ONLY"),
+    "hrvatska_posta": ("SOURCE_URL", "PARSE_ONLY_LISTING"),
+    "jadrolinija": ("SOURCE_URL_SITE", "PARSE_ONLY_LISTING"),
+    "kd_pag": ("SOURCE_URL", "PARSE_ONLY_LISTING"),
+    "komunalac_bnm": ("SOURCE_URL", "PARSE_ONLY_LISTING"),
+    "liburnija_zadar": ("SOURCE_URL", "PARSE_ONLY"),
+    "vo_sibenik": ("SOURCE_URL", "PARSE_ONLY_LISTING"),
+    "vodovod_zadar": ("SOURCE_URLS", "PARSE_ONLY"),
+}
+DEFAULT_REPEAT = 20
+
+
+# benchmarking
+# ------------
+
+def get_listing_url(module, url_name):
+    """
+    Returns the source's default page; HEP's pages are per company, unit
+    and date, so today's page of the first unit.
+    """
+    url = getattr(module, url_name)
+    url = url[0] if isinstance(url, list) else url
+    if "{company}" in url:
+        with open(module.INFRASTRUCTURE_PATH.resolve(), encoding="utf-8") as f:
+            company = json.load(f)["companies"][0]
+        url = url.format(
+            company=company["tag"],
+            unit=company["units"][0]["tag"],
+            date=date.today().strftime("%d.%m.%Y")
+        )
+    return url
+
+
+def load_page(page, verify=True):
+    """
+    Reads a saved page, or downloads it if `page` is a URL, verifying
+    the SSL certificate unless the source skips verification.
+    """
+    if page.startswith(("http://", "https://")):
+        context = SSL_CONTEXT if verify else UNVERIFIED_SSL_CONTEXT
+        return send_request(page, context=context).body
+    return Path(page).read_bytes()
+
+
+def measure(page, strainer, repeat):
+    """
+    Returns average parse time in seconds and peak allocated memory
+    in bytes for a single parse.
+    """
+    def parse():
+        BeautifulSoup(page, 'html.parser', parse_only=strainer)
+
+    duration = timeit.timeit(parse, number=repeat) / repeat
+
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return duration, peak
+
+
+def benchmark(source, page=None, subpage=False, repeat=DEFAULT_REPEAT):
+    module = importlib.import_module(source)
+    url_name, strainer_name = LISTINGS[source]
+    if subpage:
+        strainer_name = "PARSE_ONLY_SUBPAGE"
+    strainer = getattr(module, strainer_name)
+
+    if page is None:
+        page = get_listing_url(module, url_name)
+    content = load_page(page, getattr(module, "VERIFY_SSL", True))
+
+    full_duration, full_peak = measure(content, None, repeat)
+    strained_duration, strained_peak = measure(content, strainer, repeat)
+
+    print(f"{source} ({strainer_name}): {page}, {len(content)} bytes")
+    print(f"{'':<10}{'time (ms)':>12}{'peak (KiB)':>14}")
+    print(f"{'full':<10}{full_duration * 1000:>12.2f}{full_peak / 1024:>14.0f}")
+    print(
+        f"{'strained':<10}{strained_duration * 1000:>12.2f}"
+        f"{strained_peak / 1024:>14.0f}"
+    )
+    print(
+        f"{'speedup':<10}{full_duration / strained_duration:>11.1f}x"
+        f"{full_peak / strained_peak:>13.1f}x"
+    )
+
+
+# main
+# ----
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark_parsing",
+        description="Compares full and strained parsing of a source page."
+    )
+    parser.add_argument("source", choices=sorted(LISTINGS))
+    parser.add_argument(
+        "page", nargs="?",
+        help="saved page or URL (default: the source's listing page)"
+    )
+    parser.add_argument(
+        "--subpage", action="store_true",
+        help="use the subpage strainer; requires a subpage as `page`"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=DEFAULT_REPEAT,
+        help="number of parses to average over"
+    )
+    args = parser.parse_args()
+
+    if args.subpage and args.page is None:
+        parser.error("--subpage requires a page")
+
+    benchmark(args.source, args.page, args.subpage, max(1, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import argparse
+import importlib
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from backfill import (
+    BACKFILL_DATED_SOURCES, BACKFILL_MAX_PAGES, BACKFILL_SOURCES, backfill
+)
+from bundle import (
+    BUNDLE_PATH, BundleError, compile_bundle, load_bundle, save_bundle
+)
+from fetching import pop_changes, pop_failures
+from matching import PROFILE, format_profile
+from state import load_state, save_state
+from utils import PRIORITY_HIGH, PRIORITY_NORMAL
+
+
+# set constants
+# -------------
+
+SOURCES = [
+    "jadrolinija",
+    "hak",
+    "hep",
+    "hrvatska_posta",
+    "kd_pag",
+    "komunalac_bnm",
+    "liburnija_zadar",
+    "vo_sibenik",
+    "vodovod_zadar",
+]
+DEFAULT_PARALLELISM = 4
+
+# daemon mode; sources may override the interval bounds, in seconds
+POLL_INTERVAL_MIN = 30 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
+POLL_JITTER = 0.1
+POLL_HISTORY_LENGTH = 20
+# workers in daemon mode reserved for high priority sources, on top of
+# `--parallel`, so they don't wait for a long crawl
+PRIORITY_LANES = 1
+
+# report of `run --profile`, and the number of tags it prints, most
+# costly first
+MATCH_PROFILE_PATH = Path("data/match_profile.txt")
+MATCH_PROFILE_SUMMARY_LENGTH = 20
+
+
+# running
+# -------
+
+def get_priority(module):
+    return getattr(module, "PRIORITY", PRIORITY_NORMAL)
+
+
+def run_source(module):
+    """
+    Runs a single source and returns its summary; a run in which
+    a download failed is failed too, even if the source carried on.
+    """
+    started_at = time.monotonic()
+    pop_failures(module.SCRIPT_NAME)
+    try:
+        new_results = module.main() or []
+        status = "failed" if pop_failures(module.SCRIPT_NAME) else "ok"
+    except Exception:
+        logging.getLogger(module.SCRIPT_NAME).exception("Error running source")
+        new_results = []
+        status = "failed"
+
+    return {
+        "source": module.SCRIPT_NAME,
+        "status": status,
+        "new_results": len(new_results),
+        "duration": time.monotonic() - started_at,
+    }
+
+
+def run(sources, parallelism):
+    """
+    Runs sources concurrently in one process, at most `parallelism`
+    of them at a time and the most urgent first, and returns their
+    summaries in the given order.
+    """
+    # import all sources up front, so shared dependencies load only once
+    modules = [importlib.import_module(source) for source in sources]
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = {
+            module: executor.submit(run_source, module)
+            for module in sorted(modules, key=get_priority)
+        }
+        return [futures[module].result() for module in modules]
+
+
+# scheduling
+# ----------
+
+class Schedule:
+    """
+    Polling schedule of a source in daemon mode.
+
+    The interval follows how often the source's content changed over its
+    last runs: half the average time between changes, bounded by the
+    source's POLL_INTERVAL_MIN and POLL_INTERVAL_MAX, with some jitter.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.path = Path(f"{source}/data/schedule.json")
+        # [timestamp, changed] pairs of recent runs
+        self.history = load_state(self.path, list())
+
+        module = importlib.import_module(source)
+        self.priority = get_priority(module)
+        self.min_interval = getattr(
+            module, "POLL_INTERVAL_MIN", POLL_INTERVAL_MIN
+        )
+        self.max_interval = getattr(
+            module, "POLL_INTERVAL_MAX", POLL_INTERVAL_MAX
+        )
+
+        # continue where a previous daemon left off
+        if self.history:
+            self.next_run = self.history[-1][0] + self.get_interval()
+        else:
+            self.next_run = time.time()
+
+    def get_interval(self):
+        changes = sum(changed for _, changed in self.history)
+        if not changes:
+            return self.max_interval
+        span = time.time() - self.history[0][0]
+        return min(
+            self.max_interval, max(self.min_interval, span / changes / 2)
+        )
+
+    def record(self, changed):
+        """
+        Adds a run to the history and schedules the next one;
+        returns the interval until then.
+        """
+        self.history.append([time.time(), changed])
+        self.history = self.history[-POLL_HISTORY_LENGTH:]
+        save_state(self.path, self.history)
+
+        interval = self.get_interval() * random.uniform(
+            1 - POLL_JITTER, 1 + POLL_JITTER
+        )
+        self.next_run = time.time() + interval
+        return interval
+
+    def retry(self):
+        """
+        Schedules a failed run again after the minimum interval.
+        """
+        self.next_run = time.time() + self.min_interval
+        return self.min_interval
+
+
+def run_scheduled(schedule, running):
+    try:
+        # reload the source for a fresh job ID, timestamps and archive paths
+        module = importlib.reload(importlib.import_module(schedule.source))
+        pop_changes(schedule.source)
+        summary = run_source(module)
+    except Exception:
+        logging.getLogger(schedule.source).exception("Error loading source")
+        summary = {
+            "source": schedule.source,
+            "status": "failed",
+            "new_results": 0,
+            "duration": 0,
+        }
+
+    if summary["status"] == "ok":
+        changed = pop_changes(schedule.source) > 0 \
+            or summary["new_results"] > 0
+        interval = schedule.record(changed)
+    else:
+        interval = schedule.retry()
+    running.discard(schedule.source)
+
+    print(
+        f"{summary['source']}: {summary['status']}, "
+        f"{summary['new_results']} new results "
+        f"in {summary['duration']:.1f}s, "
+        f"next run in {interval / 60:.0f} min",
+        flush=True
+    )
+
+
+def serve(sources, parallelism):
+    """
+    Runs each source on its own adaptive schedule until SIGTERM or SIGINT;
+    sources that are running when stopped finish first.
+
+    Due sources start by priority, once a worker is free; high priority
+    sources may also use the PRIORITY_LANES reserved for them.
+    """
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    schedules = [Schedule(source) for source in sources]
+    running = set()
+
+    with ThreadPoolExecutor(
+        max_workers=parallelism + PRIORITY_LANES
+    ) as executor:
+        while not stopping.is_set():
+            now = time.time()
+            due = sorted(
+                (
+                    schedule for schedule in schedules
+                    if schedule.source not in running
+                    and schedule.next_run <= now
+                ),
+                key=lambda schedule: (schedule.priority, schedule.next_run)
+            )
+            for schedule in due:
+                lanes = parallelism
+                if schedule.priority == PRIORITY_HIGH:
+                    lanes += PRIORITY_LANES
+                if len(running) >= lanes:
+                    continue
+                running.add(schedule.source)
+                executor.submit(run_scheduled, schedule, running)
+            stopping.wait(1)
+
+        print("Stopping, waiting for running sources to finish", flush=True)
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def print_summary(summaries):
+    print(f"{'source':<20}{'status':<10}{'new results':>12}{'duration':>12}")
+    for summary in summaries:
+        print(
+            f"{summary['source']:<20}{summary['status']:<10}"
+            f"{summary['new_results']:>12}{summary['duration']:>11.1f}s"
+        )
+
+
+# main
+# ----
+
+def write_match_profile(path=MATCH_PROFILE_PATH):
+    """
+    Writes the match profile of the run, every evaluated tag ranked by
+    cumulative time and then the tags that never matched, and prints
+    the most costly tags.
+    """
+    rows = PROFILE.get_rows(load_bundle().describe)
+    unmatched = [row for row in rows if not row[5]]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.resolve(), "w", encoding="utf-8") as f:
+        f.write("\n".join(
+            ["Tags by cumulative time", ""]
+            + format_profile(rows)
+            + ["", "Tags that never matched", ""]
+            + format_profile(sorted(unmatched, key=lambda row: row[:4]))
+        ) + "\n")
+
+    print(
+        f"\nMatch profile: {len(rows)} tags evaluated, "
+        f"{len(unmatched)} never matched, "
+        f"{sum(row[6] for row in rows):.3f}s in total; written to {path}"
+    )
+    print("\n".join(format_profile(rows[:MATCH_PROFILE_SUMMARY_LENGTH])))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bodulica",
+        description="Runs sources in a single process."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run", help="run selected sources (default: all) once"
+    )
+    run_parser.add_argument(
+        "sources", nargs="*", metavar="source",
+        help=f"one of: {', '.join(SOURCES)}"
+    )
+    run_parser.add_argument(
+        "--parallel", type=int, default=DEFAULT_PARALLELISM,
+        help="maximum number of sources running at the same time"
+    )
+    run_parser.add_argument(
+        "--profile", action="store_true",
+        help=f"evaluate each tag on its own as well, and report its "
+             f"evaluations, hits and time in {MATCH_PROFILE_PATH}; "
+             f"slows matching down"
+    )
+
+    daemon_parser = subparsers.add_parser(
+        "daemon",
+        help="keep polling selected sources (default: all), each on "
+             "an interval adapted to how often it changes"
+    )
+    daemon_parser.add_argument(
+        "sources", nargs="*", metavar="source",
+        help=f"one of: {', '.join(SOURCES)}"
+    )
+    daemon_parser.add_argument(
+        "--parallel", type=int, default=DEFAULT_PARALLELISM,
+        help="maximum number of sources running at the same time"
+    )
+
+    backfill_parser = subparsers.add_parser(
+        "backfill",
+        help="archive older notices from a source's paginated listing, "
+             "without matching or mailing; resumes a stopped backfill"
+    )
+    backfill_parser.add_argument("source", choices=BACKFILL_SOURCES)
+    backfill_parser.add_argument(
+        "--pages", type=int, default=BACKFILL_MAX_PAGES,
+        help="maximum number of listing pages to walk"
+    )
+    backfill_parser.add_argument(
+        "--since", type=datetime.fromisoformat,
+        help=f"stop at notices published before this date, ie. 2025-01-01; "
+             f"only for {', '.join(BACKFILL_DATED_SOURCES)}"
+    )
+    backfill_parser.add_argument(
+        "--budget", type=float,
+        help="seconds the backfill may spend downloading (default: no limit)"
+    )
+
+    subparsers.add_parser(
+        "compile",
+        help="validate islands, contacts and infrastructure files and "
+             "compile them with the sources' tag indexes; runs compile "
+             "them on their own when the files change"
+    )
+
+    args = parser.parse_args()
+
+    unknown_sources = set(getattr(args, "sources", [])) - set(SOURCES)
+    if unknown_sources:
+        parser.error(f"unknown sources: {', '.join(sorted(unknown_sources))}")
+    if getattr(args, "since", None) \
+            and args.source not in BACKFILL_DATED_SOURCES:
+        parser.error(f"--since: entries of {args.source} aren't dated")
+
+    if args.command == "run":
+        PROFILE.enabled = args.profile
+        summaries = run(args.sources or SOURCES, max(1, args.parallel))
+        print_summary(summaries)
+        if args.profile:
+            write_match_profile()
+        if any(summary["status"] != "ok" for summary in summaries):
+            sys.exit(1)
+    elif args.command == "daemon":
+        serve(args.sources or SOURCES, max(1, args.parallel))
+    elif args.command == "backfill":
+        backfill(args.source, max(1, args.pages), args.since, args.budget)
+    elif args.command == "compile":
+        try:
+            bundle = compile_bundle()
+        except BundleError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        save_bundle(bundle)
+        print(
+            f"Compiled {len(bundle.islands)} islands, "
+            f"{len(bundle.settlements)} settlements and "
+            f"{len(bundle.units)} units into {BUNDLE_PATH}"
+        )
+
+
+if __name__ == "__main__":
+    main()
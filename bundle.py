@@ -0,0 +1,507 @@
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+
+from utils import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+
+
+# set constants
+# -------------
+
+BUNDLE_PATH = Path("data/bundle.pickle")
+ISLANDS_PATH = Path("islands.json")
+CONTACTS_PATH = Path("contacts.json")
+HAK_INFRASTRUCTURE_PATH = Path("hak/infrastructure")
+# sources whose matching is compiled into the bundle, each providing
+# `compile_matching(bundle)`
+BUNDLE_SOURCES = [
+    "jadrolinija",
+    "hak",
+    "hep",
+    "hrvatska_posta",
+    "kd_pag",
+    "komunalac_bnm",
+    "liburnija_zadar",
+    "vo_sibenik",
+    "vodovod_zadar",
+]
+# modules building the bundle's indexes and automata, so the bundle is
+# also rebuilt when the code producing it changes
+BUNDLE_MODULES = ["bundle", "matching", "utils"] + BUNDLE_SOURCES
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+# source files
+# ------------
+
+def get_source_paths():
+    """
+    Returns paths of the data files the bundle is compiled from.
+    """
+    return [
+        ISLANDS_PATH,
+        CONTACTS_PATH,
+        *sorted(Path().glob("*/infrastructure.json")),
+        *sorted(HAK_INFRASTRUCTURE_PATH.glob("*.json")),
+    ]
+
+
+def get_sources_fingerprint(paths):
+    """
+    Returns a hash of the source files and of the code compiling them;
+    a missing file, such as contacts.json before it's set up, hashes
+    differently from an empty one.
+    """
+    digest = hashlib.sha256()
+    code_paths = [
+        Path(__file__).with_name(f"{module}.py") for module in BUNDLE_MODULES
+    ]
+    for path in list(paths) + code_paths:
+        digest.update(str(path).encode("utf-8") + b"\0")
+        if path.exists():
+            digest.update(path.read_bytes())
+        else:
+            digest.update(b"\0missing\0")
+    return digest.hexdigest()
+
+
+def load_json(path, default):
+    if not path.exists():
+        return default
+    with open(path.resolve(), "rb") as f:
+        return json.load(f)
+
+
+# validation
+# ----------
+
+class BundleError(ValueError):
+    """
+    Raised when source files don't pass validation, with all problems
+    found listed in the message.
+    """
+
+
+def is_tags(value, optional=False):
+    if optional and value == "":
+        return True
+    return isinstance(value, str) and all(value.split(","))
+
+
+def validate_islands(islands):
+    """
+    Returns problems found in islands.json.
+    """
+    if not isinstance(islands, list):
+        return [f"{ISLANDS_PATH}: expected a list of islands"]
+
+    errors = []
+    names = set()
+    for i, island in enumerate(islands):
+        where = f"{ISLANDS_PATH}: island {i}"
+        if not isinstance(island, dict) or \
+                not isinstance(island.get("name"), str):
+            errors.append(f"{where}: missing name")
+            continue
+        where = f"{ISLANDS_PATH}: island {island['name']}"
+        if island["name"] in names:
+            errors.append(f"{where}: duplicate name")
+        names.add(island["name"])
+        if not isinstance(island.get("label"), str):
+            errors.append(f"{where}: missing label")
+        if not isinstance(island.get("settlements"), list):
+            errors.append(f"{where}: expected a list of settlements")
+            continue
+
+        settlement_names = set()
+        for j, settlement in enumerate(island["settlements"]):
+            if not isinstance(settlement, dict) or \
+                    not isinstance(settlement.get("name"), str):
+                errors.append(f"{where}: settlement {j}: missing name")
+                continue
+            settlement_where = f"{where}: settlement {settlement['name']}"
+            if settlement["name"] in settlement_names:
+                errors.append(f"{settlement_where}: duplicate name")
+            settlement_names.add(settlement["name"])
+            if not isinstance(settlement.get("label"), str):
+                errors.append(f"{settlement_where}: missing label")
+            if not is_tags(settlement.get("tags")):
+                errors.append(
+                    f"{settlement_where}: tags must be comma separated, "
+                    f"without empty tags"
+                )
+    return errors
+
+
+def validate_contacts(contacts, island_names):
+    """
+    Returns problems found in contacts.json.
+    """
+    if not isinstance(contacts, list):
+        return [f"{CONTACTS_PATH}: expected a list of islands' contacts"]
+
+    errors = []
+    for i, item in enumerate(contacts):
+        where = f"{CONTACTS_PATH}: item {i}"
+        if not isinstance(item, dict):
+            errors.append(f"{where}: expected an object")
+            continue
+        if item.get("island") not in island_names:
+            errors.append(f"{where}: unknown island {item.get('island')}")
+        emails = item.get("contacts")
+        if not isinstance(emails, list) or \
+                not all(isinstance(email, str) for email in emails):
+            errors.append(f"{where}: expected a list of email addresses")
+    return errors
+
+
+def validate_units(where, units, island_names, tagged=True):
+    """
+    Returns problems found in units of an infrastructure file; units
+    are matched by comma separated "tags", empty for sources matching
+    settlements instead, or HEP's units by a "tag".
+    """
+    if not isinstance(units, list):
+        return [f"{where}: expected a list of units"]
+
+    errors = []
+    names = set()
+    for i, unit in enumerate(units):
+        if not isinstance(unit, dict) or \
+                not isinstance(unit.get("name"), str):
+            errors.append(f"{where}: unit {i}: missing name")
+            continue
+        unit_where = f"{where}: unit {unit['name']}"
+        if unit["name"] in names:
+            errors.append(f"{unit_where}: duplicate name")
+        names.add(unit["name"])
+        if not isinstance(unit.get("label"), str):
+            errors.append(f"{unit_where}: missing label")
+        if tagged and not is_tags(unit.get("tags"), optional=True):
+            errors.append(
+                f"{unit_where}: tags must be comma separated, "
+                f"without empty tags"
+            )
+        if not tagged and not isinstance(unit.get("tag"), str):
+            errors.append(f"{unit_where}: missing tag")
+        islands = unit.get("islands")
+        if not isinstance(islands, list):
+            errors.append(f"{unit_where}: expected a list of islands")
+        else:
+            for island in islands:
+                if island not in island_names:
+                    errors.append(f"{unit_where}: unknown island {island}")
+        if unit.get("priority", PRIORITY_NORMAL) not in PRIORITIES:
+            errors.append(
+                f"{unit_where}: priority must be one of "
+                f"{', '.join(map(str, PRIORITIES))}"
+            )
+    return errors
+
+
+def validate_infrastructure(path, infrastructure, island_names):
+    """
+    Returns problems found in an infrastructure file, with either units
+    or, for HEP, companies with units.
+    """
+    if not isinstance(infrastructure, dict):
+        return [f"{path}: expected an object"]
+    if "companies" not in infrastructure:
+        return validate_units(
+            str(path), infrastructure.get("units"), island_names
+        )
+
+    companies = infrastructure["companies"]
+    if not isinstance(companies, list):
+        return [f"{path}: expected a list of companies"]
+    errors = []
+    for i, company in enumerate(companies):
+        if not isinstance(company, dict) or \
+                not isinstance(company.get("tag"), str):
+            errors.append(f"{path}: company {i}: missing tag")
+            continue
+        errors.extend(validate_units(
+            f"{path}: company {company['tag']}", company.get("units"),
+            island_names, tagged=False
+        ))
+    return errors
+
+
+# bundle
+# ------
+
+class Bundle:
+    """
+    Islands, settlements, units and contacts compiled from the source
+    files, with integer IDs and tags split once, and the tag indexes and
+    automata of each source built from them.
+
+    - Input:
+    fingerprint: hash of the source files it's compiled from
+    islands: list of dictionaries, as in islands.json
+    contacts: list of dictionaries, as in contacts.json
+
+    - Attributes:
+    islands: island names by island ID
+    island_ids: island IDs by name
+    island_labels: island labels by name
+    settlements: (island name, settlement name) pairs by settlement ID
+    settlement_tags: tuples of tags by settlement ID
+    island_settlements: tuples of settlement IDs by island name
+    contacts: tuples of email addresses by island name
+    units: unit dictionaries, as in infrastructure files, by unit ID
+    unit_tags: tuples of tags by unit ID
+    unit_ids: tuples of unit IDs by infrastructure file path
+    infrastructure: contents of infrastructure files by path
+    matching: compiled matching by source, from `compile_matching(bundle)`
+    """
+    def __init__(self, fingerprint, islands, contacts):
+        self.fingerprint = fingerprint
+
+        self.islands = tuple(island["name"] for island in islands)
+        self.island_ids = {name: i for i, name in enumerate(self.islands)}
+        self.island_labels = {
+            island["name"]: island["label"] for island in islands
+        }
+        settlements = []
+        settlement_tags = []
+        self.island_settlements = dict()
+        for island in islands:
+            ids = []
+            for settlement in island["settlements"]:
+                ids.append(len(settlements))
+                settlements.append((island["name"], settlement["name"]))
+                settlement_tags.append(tuple(settlement["tags"].split(",")))
+            self.island_settlements[island["name"]] = tuple(ids)
+        self.settlements = tuple(settlements)
+        self.settlement_tags = tuple(settlement_tags)
+
+        self.contacts = dict()
+        for item in contacts:
+            # the first entry of an island is used, as before
+            self.contacts.setdefault(item["island"], tuple(item["contacts"]))
+
+        self.units = []
+        self.unit_tags = []
+        self.unit_ids = dict()
+        self.infrastructure = dict()
+        self.matching = dict()
+
+    def add_infrastructure(self, path, infrastructure):
+        units = infrastructure.get("units") or [
+            unit for company in infrastructure.get("companies", [])
+            for unit in company["units"]
+        ]
+        ids = []
+        for unit in units:
+            ids.append(len(self.units))
+            self.units.append(unit)
+            self.unit_tags.append(
+                tuple(unit["tags"].split(",")) if unit.get("tags") else ()
+            )
+        self.unit_ids[str(path)] = tuple(ids)
+        self.infrastructure[str(path)] = infrastructure
+
+    def get_infrastructure(self, path):
+        return self.infrastructure[str(path)]
+
+    def get_unit_ids(self, *paths):
+        return [i for path in paths for i in self.unit_ids[str(path)]]
+
+    def get_units(self, *paths):
+        """
+        Returns units of infrastructure files, in order.
+        """
+        return [self.units[i] for i in self.get_unit_ids(*paths)]
+
+    def get_unit_tags(self, unit_ids):
+        """
+        Yields (tag, unit ID) pairs of the units, for `TagMatcher`.
+        """
+        for unit_id in unit_ids:
+            for tag in self.unit_tags[unit_id]:
+                yield tag, unit_id
+
+    def get_unit_names(self, unit_ids):
+        return set(self.units[unit_id]["name"] for unit_id in unit_ids)
+
+    def get_unit_name_ids(self, unit_ids):
+        """
+        Returns unit IDs by unit name, for `match_units`.
+        """
+        names = dict()
+        for unit_id in unit_ids:
+            names.setdefault(self.units[unit_id]["name"], set()).add(unit_id)
+        return names
+
+    def get_settlement_tags(self, island_names):
+        """
+        Yields (tag, settlement ID) pairs of the settlements on the given
+        islands, for `SettlementIndex` or `TagMatcher`.
+
+        - Input:
+        island_names: ['ugljan', 'pasman']
+        """
+        for island in island_names:
+            for settlement_id in self.island_settlements.get(island, ()):
+                for tag in self.settlement_tags[settlement_id]:
+                    yield tag, settlement_id
+
+    def get_settlements(self, settlement_ids):
+        """
+        Returns (island name, settlement name) pairs of settlement IDs.
+        """
+        return set(self.settlements[i] for i in settlement_ids)
+
+    def describe(self, values, value):
+        """
+        Returns the name of a unit or settlement ID, ie. for the match
+        profile.
+
+        - Input:
+        values: "units" or "settlements"
+        value: the ID
+        """
+        if values == "units":
+            return self.units[value]["name"]
+        return "/".join(self.settlements[value])
+
+    def hits_per_island(self, matrix):
+        """
+        Returns numbers of hits of the units connected to each island,
+        by island name, from a HitMatrix of `match_batch`.
+        """
+        hits = dict.fromkeys(self.islands, 0)
+        for unit_id, count in enumerate(matrix.hits_per_unit()):
+            if count:
+                for island in self.units[unit_id].get("islands", ()):
+                    hits[island] += count
+        return hits
+
+    def get_emails(self, island_names):
+        """
+        Returns email addresses of the contacts of the given islands.
+        """
+        return set(
+            email for island in island_names
+            for email in self.contacts.get(island, ())
+        )
+
+
+# compiling
+# ---------
+
+def name_matching(matching, name):
+    """
+    Names the automata and indexes of a source's compiled matching, for
+    the match profile: by the source and the keys they're found under,
+    ie. hak:maritime.
+    """
+    if isinstance(matching, dict):
+        for key, value in matching.items():
+            if isinstance(key, tuple):
+                key = "/".join(map(str, key))
+            name_matching(value, f"{name}:{key}")
+    elif isinstance(matching, (list, tuple)):
+        for value in matching:
+            name_matching(value, name)
+    else:
+        matching.name = name
+        # a settlement index's fuzzy index
+        if hasattr(matching, "fuzzy"):
+            matching.fuzzy.name = name
+
+
+def compile_bundle():
+    """
+    Validates the source files and compiles them, with each source's
+    matching, into a Bundle. Raises BundleError listing every problem
+    found.
+    """
+    paths = get_source_paths()
+    fingerprint = get_sources_fingerprint(paths)
+
+    islands = load_json(ISLANDS_PATH, None)
+    errors = validate_islands(islands)
+    if errors:
+        raise BundleError("\n".join(errors))
+    island_names = set(island["name"] for island in islands)
+
+    # no contacts until contacts.json is set up
+    contacts = load_json(CONTACTS_PATH, [])
+    errors = validate_contacts(contacts, island_names)
+
+    infrastructure = dict()
+    for path in paths:
+        if path in (ISLANDS_PATH, CONTACTS_PATH):
+            continue
+        try:
+            infrastructure[path] = load_json(path, None)
+        except ValueError as e:
+            errors.append(f"{path}: {e}")
+            continue
+        errors.extend(
+            validate_infrastructure(path, infrastructure[path], island_names)
+        )
+    if errors:
+        raise BundleError("\n".join(errors))
+
+    bundle = Bundle(fingerprint, islands, contacts)
+    for path, data in infrastructure.items():
+        bundle.add_infrastructure(path, data)
+    for source in BUNDLE_SOURCES:
+        module = importlib.import_module(source)
+        bundle.matching[source] = module.compile_matching(bundle)
+        name_matching(bundle.matching[source], source)
+    return bundle
+
+
+def save_bundle(bundle, path=BUNDLE_PATH):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path.resolve(), "wb") as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+_bundle = None
+_bundle_lock = threading.Lock()
+
+
+def load_bundle(path=BUNDLE_PATH):
+    """
+    Returns the compiled bundle, loaded from its cached artifact, or
+    compiled and cached again when a source file changed since. Within
+    a process, the bundle is loaded once and only checked for changes.
+
+    - Usage:
+    bundle = load_bundle()
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
+    index = bundle.matching[SCRIPT_NAME]
+    """
+    global _bundle
+
+    with _bundle_lock:
+        fingerprint = get_sources_fingerprint(get_source_paths())
+        if _bundle is not None and _bundle.fingerprint == fingerprint:
+            return _bundle
+
+        bundle = None
+        try:
+            with open(Path(path).resolve(), "rb") as f:
+                bundle = pickle.load(f)
+        except:
+            # missing, or written by code since changed
+            pass
+
+        if getattr(bundle, "fingerprint", None) != fingerprint:
+            bundle = compile_bundle()
+            save_bundle(bundle, path)
+
+        _bundle = bundle
+        return bundle
@@ -0,0 +1,656 @@
+import configparser
+import hashlib
+import http.client
+import ssl
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
+
+from state import load_state, save_state
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# load configuration
+# ------------------
+
+config = configparser.ConfigParser()
+config.read("config.ini")
+
+FETCH_MAX_WORKERS = config.getint('FETCHING', 'MaxWorkers', fallback=4)
+FETCH_RATE = config.getfloat('FETCHING', 'RequestsPerSecond', fallback=0.5)
+FETCH_BURST = config.getint('FETCHING', 'Burst', fallback=2)
+FETCH_RETRIES = config.getint('FETCHING', 'Retries', fallback=3)
+FETCH_RETRY_BACKOFF = config.getfloat('FETCHING', 'RetryBackoff', fallback=2)
+FETCH_CONNECT_TIMEOUT = config.getfloat(
+    'FETCHING', 'ConnectTimeout', fallback=10
+)
+FETCH_READ_TIMEOUT = config.getfloat('FETCHING', 'ReadTimeout', fallback=30)
+FETCH_RUN_BUDGET = config.getfloat('FETCHING', 'RunBudget', fallback=600)
+
+
+# politeness
+# ----------
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, refilled at `rate` tokens per second
+    up to `capacity` tokens.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+def get_host_bucket(host):
+    """
+    Returns the token bucket shared by all requests to a host.
+
+    Limits default to the [FETCHING] section of the config file and can be
+    overridden per host, ie. a [FETCHING:www.hep.hr] section.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            section = f'FETCHING:{host}'
+            rate = config.getfloat(
+                section, 'RequestsPerSecond', fallback=FETCH_RATE
+            )
+            burst = config.getint(section, 'Burst', fallback=FETCH_BURST)
+            bucket = TokenBucket(rate, burst)
+            _buckets[host] = bucket
+        return bucket
+
+
+# connections
+# -----------
+
+# SSL contexts are shared, so TLS settings are set up only once per process
+SSL_CONTEXT = ssl.create_default_context()
+UNVERIFIED_SSL_CONTEXT = ssl._create_unverified_context()
+
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+
+# brotli is optional; install the `brotli` package to enable it
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli else "gzip, deflate"
+
+Response = namedtuple(
+    "Response", ["url", "status", "headers", "body", "wire_length", "digest"]
+)
+
+
+class Decoder:
+    """
+    Streaming decoder for a response's Content-Encoding.
+    """
+    def __init__(self, encoding):
+        self.encoding = (encoding or "identity").strip().lower()
+        if self.encoding in ("gzip", "x-gzip"):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decompressor = zlib.decompressobj()
+        elif self.encoding == "br" and brotli:
+            self.decompressor = brotli.Decompressor()
+        elif self.encoding == "identity":
+            self.decompressor = None
+        else:
+            raise ValueError(f"Unsupported content encoding: {encoding}")
+        self.started = False
+
+    def decode(self, chunk):
+        if self.decompressor is None:
+            return chunk
+        if self.encoding == "br":
+            return self.decompressor.process(chunk)
+        if self.encoding == "deflate" and not self.started:
+            # some servers send raw deflate data without the zlib header
+            self.started = True
+            try:
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        if self.decompressor is None or self.encoding == "br":
+            return b""
+        return self.decompressor.flush()
+
+
+def read_response(response):
+    """
+    Reads and decodes a response body chunk by chunk, hashing it
+    on the way.
+
+    Returns the decoded body, the number of bytes read on the wire and
+    the SHA-256 digest of the decoded body.
+    """
+    decoder = Decoder(response.headers.get("Content-Encoding"))
+    digest = hashlib.sha256()
+    chunks = []
+    wire_length = 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        wire_length += len(chunk)
+        chunks.append(decoder.decode(chunk))
+        digest.update(chunks[-1])
+    chunks.append(decoder.flush())
+    digest.update(chunks[-1])
+    return b"".join(chunks), wire_length, digest.hexdigest()
+
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection with separate connect and read timeouts; the read
+    timeout bounds every wait for data from the server.
+    """
+    def __init__(self, host, port=None):
+        super().__init__(host, port, timeout=FETCH_CONNECT_TIMEOUT)
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(FETCH_READ_TIMEOUT)
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection that resumes the last TLS session to the same host,
+    with separate connect and read timeouts.
+    """
+    def __init__(self, host, port=None, context=None, sessions=None):
+        super().__init__(
+            host, port, context=context, timeout=FETCH_CONNECT_TIMEOUT
+        )
+        self.sessions = sessions
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        key = (self.host, self.port, self._context)
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=self.host,
+            session=self.sessions.get(key)
+        )
+        self.sock.settimeout(FETCH_READ_TIMEOUT)
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections per scheme, host, port
+    and SSL context, so requests to the same host reuse them.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.idle = defaultdict(list)
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns an idle connection or a new one, and whether it's reused.
+        """
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+        return self.connect(key), False
+
+    def connect(self, key):
+        scheme, host, port, context = key
+        if scheme == 'https':
+            return PooledHTTPSConnection(
+                host, port, context=context, sessions=self.sessions
+            )
+        return PooledHTTPConnection(host, port)
+
+    def release(self, key, connection):
+        # remember the TLS session for new connections to the same host
+        session = getattr(connection.sock, 'session', None)
+        with self.lock:
+            if session is not None:
+                self.sessions[
+                    (connection.host, connection.port, key[3])
+                ] = session
+            if len(self.idle[key]) < self.maxsize:
+                self.idle[key].append(connection)
+                return
+        connection.close()
+
+    def request(self, method, url, headers, body=None, context=None):
+        parsed_url = urlparse(url)
+        if parsed_url.scheme == 'https':
+            context = context or SSL_CONTEXT
+        else:
+            context = None
+        key = (
+            parsed_url.scheme, parsed_url.hostname, parsed_url.port, context
+        )
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path = f'{path}?{parsed_url.query}'
+
+        connection, reused = self.get(key)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            connection.close()
+            if not reused:
+                raise
+            # the server closed an idle keep-alive connection;
+            # retry once on a new connection
+            connection = self.connect(key)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        try:
+            data, wire_length, digest = read_response(response)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+        return Response(
+            url, response.status, response.headers, data, wire_length, digest
+        )
+
+
+POOL = ConnectionPool(maxsize=FETCH_MAX_WORKERS)
+
+
+def send_request(url, headers=None, data=None, method='GET', context=None):
+    """
+    Sends a request through the shared connection pool, negotiating
+    compression, and follows redirects.
+
+    Raises HTTPError for error responses, like `urlopen` does.
+    """
+    headers = dict(headers or dict())
+    headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
+    for _ in range(MAX_REDIRECTS + 1):
+        response = POOL.request(
+            method, url, headers, body=data, context=context
+        )
+        location = response.headers.get('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            if response.status == 303:
+                method, data = 'GET', None
+            continue
+        if response.status >= 400:
+            raise HTTPError(
+                url, response.status, http.client.responses.get(
+                    response.status, ''
+                ), response.headers, None
+            )
+        return response
+    raise HTTPError(
+        url, response.status, 'Too many redirects', response.headers, None
+    )
+
+
+class RunBudgetExceeded(Exception):
+    """
+    Raised instead of downloading a URL once the run's budget is spent.
+    """
+
+
+def is_retryable(error):
+    """
+    Whether a failed request may succeed if repeated: network errors,
+    timeouts, server errors and rate limiting.
+    """
+    if isinstance(error, RunBudgetExceeded):
+        return False
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return True
+
+
+# caching
+# -------
+
+# validators of URLs not requested for this long are evicted, ie. of
+# dated or filtered URLs and of subpages which dropped off a listing
+HTTP_CACHE_MAX_AGE = 14 * 24 * 60 * 60
+
+class HttpCache:
+    """
+    Disk-backed store of HTTP validators (ETag, Last-Modified) per URL,
+    used to make conditional requests.
+
+    Validators of new responses are kept aside until `save` is called,
+    so a run that fails before processing a response downloads it again
+    on the next run. Entries not requested within `max_age` seconds are
+    evicted on `save`.
+    """
+    def __init__(self, path, max_age=HTTP_CACHE_MAX_AGE):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.pending = dict()
+        self.requested = set()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.entries = load_state(self.path, dict())
+
+    def get_validators(self, url):
+        """
+        Returns conditional request headers for a URL.
+        """
+        entry = self.entries.get(url, dict())
+        headers = dict()
+        with self.lock:
+            self.requested.add(url)
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        with self.lock:
+            self.stats["hits" if headers else "misses"] += 1
+        return headers
+
+    def not_modified(self, url):
+        with self.lock:
+            self.stats["not_modified"] += 1
+            self.stats["bytes_saved"] += self.entries[url].get("length", 0)
+
+    def update(self, url, headers, length):
+        """
+        Records a downloaded page.
+        """
+        with self.lock:
+            # missing validators replace stale ones
+            self.pending[url] = {
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "length": length,
+            }
+
+    def discard(self):
+        """
+        Forgets validators of this run's responses, so their pages are
+        downloaded in full on the next run.
+        """
+        with self.lock:
+            self.pending = dict()
+
+    def save(self):
+        now = time.time()
+        self.entries.update(self.pending)
+        self.pending = dict()
+        for url in self.requested:
+            if url in self.entries:
+                self.entries[url]["requested_at"] = now
+        self.requested = set()
+        # evict entries not requested for a while
+        self.entries = {
+            url: entry for url, entry in self.entries.items()
+            if now - entry.setdefault("requested_at", now) <= self.max_age
+        }
+        save_state(self.path, self.entries)
+
+    def summary(self):
+        return f"{self.stats['hits']} hits, {self.stats['misses']} misses, "\
+            f"{self.stats['not_modified']} not modified "\
+            f"(~{self.stats['bytes_saved'] / 1024:.1f} kB saved)"
+
+
+# fetching
+# --------
+
+# content changes per source, counted when a run commits, and downloads
+# that failed, counted as they fail
+_changes = Counter()
+_failures = Counter()
+_changes_lock = threading.Lock()
+
+class Fetcher:
+    """
+    Downloads pages for a single run of a source.
+
+    - Input:
+    logger: the source's logger
+    headers: request headers sent with every request
+    cache_path: optional path of the source's HTTP cache file; when set,
+    requests are conditional and unchanged pages are skipped
+    verify: whether to verify the source's SSL certificate
+    budget: seconds the run may spend downloading; URLs still pending
+    afterwards are skipped
+    """
+    def __init__(
+        self, logger, headers=None, cache_path=None, verify=True,
+        budget=FETCH_RUN_BUDGET
+    ):
+        self.logger = logger
+        self.deadline = time.monotonic() + budget
+        self.headers = headers or dict()
+        self.cache = HttpCache(cache_path) if cache_path else None
+        self.context = SSL_CONTEXT if verify else UNVERIFIED_SSL_CONTEXT
+        self.stats = Counter()
+        self.failed = []
+        self.skipped = []
+        # failed URLs refused with a client error, see `fail`
+        self.refused = []
+        # content changes found by the run, see `add_changes`
+        self.changes = 0
+        # SHA-256 digests of downloaded pages
+        self.digests = dict()
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        """
+        Downloads a single URL, retrying failed attempts with exponential
+        backoff. Client errors (4xx except 429) aren't retried.
+
+        Returns the response body or None if the page wasn't modified
+        since the last run.
+        """
+        for attempt in range(FETCH_RETRIES + 1):
+            try:
+                return self.fetch_once(url)
+            except Exception as e:
+                if attempt == FETCH_RETRIES or not is_retryable(e):
+                    raise
+                delay = FETCH_RETRY_BACKOFF * 2 ** attempt
+                if time.monotonic() + delay >= self.deadline:
+                    raise RunBudgetExceeded(url) from e
+                self.logger.warning(
+                    f"Error downloading {url} ({e}), retrying in {delay:.0f}s"
+                )
+                time.sleep(delay)
+
+    def fetch_once(self, url):
+        """
+        Downloads a single URL once the host's politeness limit allows it.
+        """
+        if time.monotonic() >= self.deadline:
+            raise RunBudgetExceeded(url)
+        get_host_bucket(urlparse(url).netloc).acquire()
+        if time.monotonic() >= self.deadline:
+            raise RunBudgetExceeded(url)
+        headers = dict(self.headers)
+        if self.cache:
+            headers.update(self.cache.get_validators(url))
+        response = send_request(url, headers, context=self.context)
+
+        # record bytes on the wire versus decoded bytes per request
+        self.logger.info(
+            f"Downloaded {url}: {response.wire_length} B on the wire, "
+            f"{len(response.body)} B decoded"
+        )
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["wire_bytes"] += response.wire_length
+            self.stats["decoded_bytes"] += len(response.body)
+
+        if response.status == 304:
+            if self.cache:
+                self.cache.not_modified(url)
+            return None
+        if self.cache:
+            self.cache.update(url, response.headers, response.wire_length)
+        with self.lock:
+            self.digests[url] = response.digest
+        return response.body
+
+    def make_requests(self, urls, listing=False):
+        """
+        Downloads URLs concurrently and yields (url, response) pairs
+        in the order of `urls`, skipping pages that weren't modified.
+
+        A download that fails after all retries is logged and recorded
+        in `failed`, and the remaining URLs are still downloaded. Once the
+        run budget is spent, remaining URLs are also recorded in `skipped`.
+        With `listing`, the URLs are listings, which fail the run also
+        when refused with a client error.
+        """
+        with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as executor:
+            futures = [
+                (url, executor.submit(self.fetch, url)) for url in urls
+            ]
+            try:
+                for url, future in futures:
+                    try:
+                        response = future.result()
+                    except RunBudgetExceeded:
+                        self.logger.warning(
+                            f"Skipped {url}: run budget exhausted"
+                        )
+                        self.fail(url)
+                        self.skipped.append(url)
+                        continue
+                    except Exception as e:
+                        self.logger.error(f"Error downloading data: {url}")
+                        refused = isinstance(e, HTTPError) \
+                            and not is_retryable(e)
+                        self.fail(url, refused=refused and not listing)
+                        continue
+                    if response is None:
+                        continue
+                    yield url, response.decode('utf-8')
+            finally:
+                for _, future in futures:
+                    future.cancel()
+
+    def add_changes(self, count):
+        """
+        Records changes of the source's content found by the run, ie. new
+        notices or changed items, rather than changed page bytes, which
+        also follow timestamps on the pages; polling in daemon mode
+        adapts to them.
+        """
+        self.changes += count
+
+    def fail(self, url, refused=False):
+        """
+        Records a download that failed after all retries, so the run
+        is reported as failed; sources downloading with `fetch` call it
+        when they give up on a URL, ie. a listing.
+
+        A subpage `refused` for good with a client error, ie. 404 of
+        a removed notice, doesn't fail the run, which would otherwise
+        fail and be retried on every run.
+        """
+        with self.lock:
+            self.failed.append(url)
+            if refused:
+                self.refused.append(url)
+        if not refused:
+            with _changes_lock:
+                _failures[self.logger.name] += 1
+
+    def commit(self):
+        """
+        Persists validators of the processed responses and logs
+        transfer and cache statistics. Call once the run's results
+        are written.
+
+        A run in which a download failed, other than one refused for
+        good, keeps the previous validators, so the next run downloads
+        listings in full again instead of getting 304 and missing the
+        failed URLs.
+        """
+        self.logger.info(
+            f"Transfer: {self.stats['requests']} requests, "
+            f"{self.stats['wire_bytes'] / 1024:.1f} kB on the wire, "
+            f"{self.stats['decoded_bytes'] / 1024:.1f} kB decoded"
+        )
+        if self.skipped:
+            self.logger.warning(
+                f"Failed: {len(self.failed)} URLs "
+                f"({len(self.skipped)} skipped, run budget exhausted), "
+                f"retried on the next run"
+            )
+        elif self.failed:
+            self.logger.warning(
+                f"Failed: {len(self.failed)} URLs, retried on the next run"
+            )
+        if self.cache:
+            if len(self.failed) > len(self.refused):
+                self.cache.discard()
+            self.cache.save()
+            self.logger.info(f"HTTP cache: {self.cache.summary()}")
+        with _changes_lock:
+            _changes[self.logger.name] += self.changes
+
+
+def pop_changes(source):
+    """
+    Returns the number of content changes the source's runs found
+    since the last call, used to adapt polling in daemon mode.
+    """
+    with _changes_lock:
+        return _changes.pop(source, 0)
+
+
+def pop_failures(source):
+    """
+    Returns the number of downloads of the source's runs that failed
+    since the last call.
+    """
+    with _changes_lock:
+        return _failures.pop(source, 0)
@@ -3,19 +3,23 @@ import logging
 import random
 import shutil
 import string
-import sys
-import unicodedata
+import time
 from datetime import datetime
 from pathlib import Path
-from time import sleep
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import FETCH_RUN_BUDGET, Fetcher
+from matching import TagMatcher, match_units
+from state import Fingerprints, get_fingerprint, load_state, save_state
 from utils import (
+    PRIORITY_HIGH,
     get_email_footer,
+    get_strainer,
     send_email,
-    contains_variant
+    normalize_for_match,
+    setup_logging,
 )
 
 
@@ -26,7 +30,12 @@ COMPANY_NAME = "HAK"
 SCRIPT_NAME = "hak"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
-DOWNLOAD_DELAY = 3
+# urgency of the source's runs in daemon mode and of its emails;
+# units may override it with a "priority" key
+PRIORITY = PRIORITY_HIGH
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 5 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 
 SOURCE_URL_MARITIME = "https://m.hak.hr/stanje.asp?id=3"
 INFRASTRUCTURE_PATHS_MARITIME = [
@@ -43,6 +52,8 @@ INFRASTRUCTURE_PATHS_MARITIME = [
 DOWNLOAD_PATH_MARITIME = Path(f"{SCRIPT_NAME}/data/page_mar.html")
 ARCHIVE_PATH_MARITIME = Path(f"{SCRIPT_NAME}/data/page_mar_{NOW}_{JOB_ID}.html")
 RESULTS_PATH_MARITIME = Path(f"{SCRIPT_NAME}/results_mar.log")
+HTTP_CACHE_PATH_MARITIME = Path(f"{SCRIPT_NAME}/data/http_cache_mar.json")
+ITEMS_PATH_MARITIME = Path(f"{SCRIPT_NAME}/data/items_mar.json")
 
 SOURCE_URL_ROADS = "https://m.hak.hr/stanje.asp?id=1"
 INFRASTRUCTURE_PATHS_ROADS = [
@@ -55,37 +66,67 @@ INFRASTRUCTURE_PATHS_ROADS = [
 DOWNLOAD_PATH_ROADS = Path(f"{SCRIPT_NAME}/data/page_roads.html")
 ARCHIVE_PATH_ROADS = Path(f"{SCRIPT_NAME}/data/page_roads_{NOW}_{JOB_ID}.html")
 RESULTS_PATH_ROADS = Path(f"{SCRIPT_NAME}/results_roads.log")
+HTTP_CACHE_PATH_ROADS = Path(f"{SCRIPT_NAME}/data/http_cache_roads.json")
+ITEMS_PATH_ROADS = Path(f"{SCRIPT_NAME}/data/items_roads.json")
 
+# page digests of both sources, by URL
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY = get_strainer(
+    ('div', {'id': 'sitno'}), ('ul', {'class': 'pageitem'})
+)
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
+logger = logging.getLogger(SCRIPT_NAME)
 
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
 
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
+# processing
+# ----------
 
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+def compile_matching(bundle):
+    """
+    Returns automata of the maritime and road units' tags, compiled
+    with the bundle.
+    """
+    # maritime tags match spelling variants, road tags match as they are
+    return {
+        "maritime": TagMatcher(
+            bundle.get_unit_tags(
+                bundle.get_unit_ids(*INFRASTRUCTURE_PATHS_MARITIME)
+            ),
+            normalize=normalize_for_match
+        ),
+        "roads": TagMatcher(
+            bundle.get_unit_tags(
+                bundle.get_unit_ids(*INFRASTRUCTURE_PATHS_ROADS)
+            ),
+            normalize=None
+        ),
+    }
 
 
-# processing
-# ----------
+def match_item(text, bundle, matcher, names):
+    """
+    Returns names of the units an item of the page mentions.
+    """
+    content = text.strip().replace(';', ' ').replace(':', ' ')
+
+    # find unit name and tags in field value;
+    # use unit name (a number) as a separate tag
+    # due to mixing with other numbers in value -
+    # sorted by splitting field value by space
+    return [
+        bundle.units[unit_id].get("name")
+        for unit_id in sorted(match_units([content], matcher, names))
+    ]
 
-def process(source='maritime'):
+
+def process(source='maritime', budget=FETCH_RUN_BUDGET):
     # handle source
     if source == 'maritime':
         SOURCE_URL = SOURCE_URL_MARITIME
@@ -93,12 +134,16 @@ def process(source='maritime'):
         DOWNLOAD_PATH = DOWNLOAD_PATH_MARITIME
         ARCHIVE_PATH = ARCHIVE_PATH_MARITIME
         RESULTS_PATH = RESULTS_PATH_MARITIME
+        HTTP_CACHE_PATH = HTTP_CACHE_PATH_MARITIME
+        ITEMS_PATH = ITEMS_PATH_MARITIME
     if source == 'roads':
         SOURCE_URL = SOURCE_URL_ROADS
         INFRASTRUCTURE_PATHS = INFRASTRUCTURE_PATHS_ROADS
         DOWNLOAD_PATH = DOWNLOAD_PATH_ROADS
         ARCHIVE_PATH = ARCHIVE_PATH_ROADS
         RESULTS_PATH = RESULTS_PATH_ROADS
+        HTTP_CACHE_PATH = HTTP_CACHE_PATH_ROADS
+        ITEMS_PATH = ITEMS_PATH_ROADS
 
     # prepare headers
     headers = {
@@ -107,34 +152,32 @@ def process(source='maritime'):
                       'Chrome/107.0.0.0 Safari/537.36'
     }
 
+    fetcher = Fetcher(
+        logger, headers, cache_path=HTTP_CACHE_PATH, budget=budget
+    )
+
     # download the page
     try:
-        request = Request(SOURCE_URL)
-        for key, value in headers.items(): 
-            request.add_header(key, value)
-        response = urlopen(request).read()
+        response = fetcher.fetch(SOURCE_URL)
     except:
         logger.error(f"Error downloading data")
-        return
+        fetcher.fail(SOURCE_URL)
+        return []
 
-    # create a download file it doesn't exist
-    if not DOWNLOAD_PATH.exists():
-        f = DOWNLOAD_PATH.open("wb+")
-        f.close()
+    # the page wasn't modified since the last run
+    if response is None:
+        fetcher.commit()
+        return []
 
-    # check if new data available
-    f = DOWNLOAD_PATH.open("rb")
-    existing_data = f.read()
-    f.close()
-    if existing_data == response:
-        return
-    
-    # load infrastructure data
-    units = list()
-    for infrastructure_path in INFRASTRUCTURE_PATHS:
-        with open(infrastructure_path.resolve(), "rb") as f:
-            infrastructure = json.load(f)
-            units.extend(infrastructure.get("units"))
+    # check if new data available by the page's digest
+    digests = Fingerprints(DIGESTS_PATH)
+    if not digests.changed(SOURCE_URL, fetcher.digests[SOURCE_URL]):
+        fetcher.commit()
+        return []
+
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
+    units = bundle.get_units(*INFRASTRUCTURE_PATHS)
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -148,48 +191,53 @@ def process(source='maritime'):
         ]
 
     # process response
-    soup = BeautifulSoup(response, 'html.parser')
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY
+    )
     date_time_raw = soup.find('div', {'id': 'sitno'}).text
     date_raw, time_raw = date_time_raw.replace(
         'Pomorski promet', ''
     ).split(' ')
-    content_raw = soup.find('ul', {'class': 'pageitem'}).text
-    content = content_raw.strip().replace(
-        ';', ' '
-    ).replace(
-        ':', ' '
+    items = soup.find('ul', {'class': 'pageitem'}).find_all(
+        'li', recursive=False
     )
 
-    results = []
-
-    for unit in units:
-        unit_name = unit.get("name")
-        result = unit_name
-        # check first if there is already a result for this unit
-        if result not in results:
-            unit_tags = unit.get("tags").split(",")
-            # &nbsp; turns into \xa0 when splitting and
-            # slavic alphabet characters are not parsed correctly,
-            # so we normalize first
-            content_value = unicodedata.normalize(
-                "NFKC", content.lower()
-            )
-            # find unit name and tags in field value;
-            # use unit name (a number) as a separate tag
-            # due to mixing with other numbers in value -
-            # sorted by splitting field value by space
-            if unit_name in content_value.split(" "):
-                results.append(result)
-            for tag in unit_tags:
-                if source == 'maritime':
-                    if contains_variant(content.lower(), tag):
-                        results.append(result)
-                if source == 'roads':
-                    if tag in content.lower():
-                        results.append(result)
+    # units matched by items of previous runs, by item fingerprint;
+    # discarded when the infrastructure changes
+    units_fingerprint = get_fingerprint(json.dumps(units))
+    item_state = load_state(ITEMS_PATH, dict())
+    if item_state.get("units") != units_fingerprint:
+        item_state = {"units": units_fingerprint, "items": dict()}
+
+    # tags of the source's units, compiled with the bundle
+    matcher = bundle.matching[SCRIPT_NAME][source]
+    names = bundle.get_unit_name_ids(
+        bundle.get_unit_ids(*INFRASTRUCTURE_PATHS)
+    )
+
+    # match only new or changed items
+    matched_items = dict()
+    for item in items:
+        fingerprint = get_fingerprint(item.text)
+        if fingerprint in matched_items:
+            continue
+        matched = item_state["items"].get(fingerprint)
+        if matched is None:
+            matched = match_item(item.text, bundle, matcher, names)
+        matched_items[fingerprint] = matched
+    changed_items = len(set(matched_items) - set(item_state["items"]))
+    logger.info(
+        f"Matched {changed_items} new or changed of {len(items)} items"
+    )
+    # new or changed items, rather than the page's bytes, which follow
+    # its timestamp, adapt polling in daemon mode
+    fetcher.add_changes(changed_items)
 
     # remove duplicate new results
-    results = list(set(results))
+    results = list(set(
+        unit_name for matched in matched_items.values()
+        for unit_name in matched
+    ))
 
     # check for new results
     new_results = []
@@ -197,10 +245,6 @@ def process(source='maritime'):
         if item not in existing_results:
             new_results.append(item)
 
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # send email notifications
     for result in new_results:
         # construct an email message
@@ -212,6 +256,13 @@ def process(source='maritime'):
             ),
             ''
         )
+        priority = next(
+            (
+                item.get("priority", PRIORITY) for item in units \
+                    if item.get("name") == unit_name
+            ),
+            PRIORITY
+        )
         subject = f'{COMPANY_NAME} | {unit_label}'
         if source == 'maritime':
             body = f'<!DOCTYPE html><html><body>'\
@@ -236,20 +287,8 @@ def process(source='maritime'):
             ),
             []
         )
-        emails_all = []
-        # collect contacts' emails connected to this island
-        for island in islands:
-            emails = next(
-                (
-                    item.get("contacts") for item in contacts \
-                        if item.get("island") == island
-                ),
-                []
-            )
-            emails_all.extend(emails)
-
-        # remove duplicate emails
-        emails_all = list(set(emails_all))
+        # collect contacts' emails connected to these islands
+        emails_all = list(bundle.get_emails(islands))
         
         # log what is to be sent
         emails_str = ",".join(emails_all) if emails_all \
@@ -260,7 +299,7 @@ def process(source='maritime'):
         )
 
         # send emails
-        send_email(emails_all, subject, body)
+        send_email(emails_all, subject, body, priority=priority)
 
     # write results
     with open(RESULTS_PATH.resolve(), "w+", encoding="utf-8") as f:
@@ -278,14 +317,28 @@ def process(source='maritime'):
         str(ARCHIVE_PATH.resolve())
     )
 
+    fetcher.commit()
+    digests.save()
+    # keep only items still on the page
+    save_state(
+        ITEMS_PATH, {"units": units_fingerprint, "items": matched_items}
+    )
+
+    return new_results
+
 
 # main
 # ----
 
 def main():
-    process(source='maritime')
-    sleep(DOWNLOAD_DELAY)
-    process(source='roads')
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    # both pages share the run's download budget
+    deadline = time.monotonic() + FETCH_RUN_BUDGET
+    new_results = process(source='maritime')
+    new_results += process(
+        source='roads', budget=deadline - time.monotonic()
+    )
+    return new_results
 
 
 if __name__ == "__main__":
@@ -1,23 +1,39 @@
 import json
 import logging
 import random
-import re
 import shutil
 import string
-import sys
 import time
+from collections import defaultdict
 from datetime import date, datetime, timedelta
 from pathlib import Path
 from urllib.parse import parse_qs, urlparse
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import (
+    Document,
+    SettlementIndex,
+    TagMatcher,
+    capitalize_tag,
+    format_fuzzy_hits,
+)
+from state import (
+    Checkpoint,
+    Fingerprints,
+    get_fingerprint,
+    load_state,
+    save_state,
+)
 from utils import (
+    PRIORITY_NORMAL,
     get_email_footer,
-    get_settlement_names_and_tags,
+    get_strainer,
     get_weekday_in_lang,
     send_email,
+    setup_logging,
 )
 
 
@@ -28,59 +44,125 @@ COMPANY_NAME = "HEP"
 SCRIPT_NAME = "hep"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails
+PRIORITY = PRIORITY_NORMAL
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 60 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 SOURCE_URL = 'https://www.hep.hr/ods/bez-struje/19' \
     '?dp={company}&el={unit}&datum={date}'
 INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_PATH = Path(f"{SCRIPT_NAME}/data/data.json")
 ARCHIVE_PATH = Path(f"{SCRIPT_NAME}/data/data_{NOW}_{JOB_ID}.json")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
+CHECKPOINT_PATH = Path(f"{SCRIPT_NAME}/data/checkpoint.json")
+FINGERPRINTS_PATH = Path(f"{SCRIPT_NAME}/data/fingerprints.json")
+POLL_POLICY_PATH = Path(f"{SCRIPT_NAME}/data/poll_policy.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY = get_strainer(('div', {'class': 'radwrap'}))
+# poll intervals of a (company, unit, date) cell by days ahead, in seconds;
+# today's cells are polled on every run
+CELL_POLL_INTERVALS = [0, 2 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60]
+# cells without planned outages back off up to this interval
+CELL_POLL_INTERVAL_MAX = 24 * 60 * 60
+# tolerate runs starting a bit early, ie. cron runs
+CELL_POLL_SLACK = 15 * 60
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
+logger = logging.getLogger(SCRIPT_NAME)
 
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
 
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
+# processing
+# ----------
 
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+def get_cell_key(url):
+    """
+    Returns the (company, unit, date) key of a page URL as a string.
+    """
+    query = parse_qs(urlparse(url).query)
+    return f"{query['dp'][0]}|{query['el'][0]}|{query['datum'][0]}"
+
+
+def get_days_ahead(cell_key):
+    cell_date = datetime.strptime(cell_key.rpartition('|')[2], "%d.%m.%Y")
+    return (cell_date.date() - date.today()).days
+
+
+def is_current(cell_key):
+    return get_days_ahead(cell_key) >= 0
+
+
+def is_due(cell_key, cell, now):
+    """
+    Returns whether a cell should be polled: cells with no planned outages
+    back off exponentially, and cells that just changed are polled sooner.
+
+    - Input:
+    cell: the cell's poll state; polled_at, empty_runs (consecutive polls
+    without planned outages) and changed (new outages on the last poll)
+    """
+    days_ahead = get_days_ahead(cell_key)
+    if cell is None or days_ahead <= 0:
+        return True
+    interval = CELL_POLL_INTERVALS[min(days_ahead, 3)]
+    if cell["changed"]:
+        interval = interval / 2
+    else:
+        interval = min(
+            CELL_POLL_INTERVAL_MAX, interval * 2 ** cell["empty_runs"]
+        )
+    return now - cell["polled_at"] >= interval - CELL_POLL_SLACK
 
 
-# processing
-# ----------
+def save_poll_policy(poll_policy):
+    save_state(
+        POLL_POLICY_PATH,
+        {
+            cell_key: cell for cell_key, cell in poll_policy.items()
+            if is_current(cell_key)
+        }
+    )
+
+
+def compile_matching(bundle):
+    """
+    Returns settlement indexes of the company units, by company and unit
+    tag, compiled with the bundle.
+    """
+    infrastructure = bundle.get_infrastructure(INFRASTRUCTURE_PATH)
+
+    # index each unit's islands' settlements: by tags equal to a whole
+    # place and by capitalized tags in a place, since sometimes
+    # settlement names are grouped in one line and separated with a comma
+    indexes = dict()
+    for company in infrastructure.get("companies"):
+        for unit in company.get("units"):
+            tags = list(bundle.get_settlement_tags(unit.get("islands")))
+            indexes[(company["tag"], unit["tag"])] = (
+                SettlementIndex(tags),
+                TagMatcher(
+                    (
+                        (capitalize_tag(tag), settlement_id)
+                        for tag, settlement_id in tags
+                    ),
+                    normalize=None,
+                    values="settlements"
+                ),
+            )
+    return indexes
 
-def make_requests(headers, urls):
-    for url in urls:
-        time.sleep(random.randrange(4,9))
-        try:
-            request = Request(url)
-            for key, value in headers.items(): 
-                request.add_header(key, value)
-            response = urlopen(request).read().decode('utf-8')
-            yield url, response
-        except:
-            logger.error(f"Error downloading data")
-            return
 
 def process():
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        companies = infrastructure.get("companies")
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
+    companies = bundle.get_infrastructure(INFRASTRUCTURE_PATH)["companies"]
 
     # generate dates (today + 3 days in advance)
     dates_generated = list()
@@ -109,17 +191,52 @@ def process():
                       'AppleWebKit/605.1.15 (KHTML, like Gecko) ' \
                       'Version/17.4.1 Safari/605.1.15'
     }
+    fetcher = Fetcher(logger, headers, cache_path=HTTP_CACHE_PATH)
+
+    # resume pages processed by an unfinished previous run
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    entries = []
+    for url, restored in checkpoint.restore(urls):
+        entries.extend(restored)
+
+    # poll only cells which are due
+    poll_policy = load_state(POLL_POLICY_PATH, dict())
+    now = time.time()
+    due_urls = [
+        url for url in checkpoint.pending(urls)
+        if is_due(get_cell_key(url), poll_policy.get(get_cell_key(url)), now)
+    ]
+    logger.info(f"Polling {len(due_urls)} of {len(urls)} pages")
 
     # start making requests
-    responses = make_requests(headers, urls)
+    responses = fetcher.make_requests(due_urls)
+
+    # skip pages unchanged since the last run; their results are
+    # already recorded
+    fingerprints = Fingerprints(FINGERPRINTS_PATH)
 
     # scrape responses & collect entries
-    entries = []
     for url, response in responses:
-        if 'Nema planiranih' in response:
+        cell_key = get_cell_key(url)
+        empty = 'Nema planiranih' in response
+        changed = fingerprints.changed(cell_key, get_fingerprint(response))
+
+        cell = poll_policy.get(cell_key, dict())
+        poll_policy[cell_key] = {
+            "polled_at": now,
+            "empty_runs": cell.get("empty_runs", 0) + 1 if empty else 0,
+            "changed": changed and not empty,
+        }
+
+        if empty or not changed:
+            checkpoint.add(url, [])
             continue
+        # changed cells with outages adapt polling in daemon mode
+        fetcher.add_changes(1)
 
-        soup = BeautifulSoup(response, 'html.parser')
+        soup = BeautifulSoup(
+            response, 'html.parser', parse_only=PARSE_ONLY
+        )
         content = soup.find('div', {'class': 'radwrap'}).text
 
         # no discernible information available on source site
@@ -147,6 +264,20 @@ def process():
             "body": body
         }
         entries.append(entry)
+        checkpoint.add(url, [entry])
+
+    # pages which weren't modified keep backing off if they were empty
+    for url in due_urls:
+        cell_key = get_cell_key(url)
+        cell = poll_policy.get(cell_key, dict())
+        if url in fetcher.failed or cell.get("polled_at") == now:
+            continue
+        empty_runs = cell.get("empty_runs", 0)
+        poll_policy[cell_key] = {
+            "polled_at": now,
+            "empty_runs": empty_runs + 1 if empty_runs else 0,
+            "changed": False,
+        }
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -157,9 +288,9 @@ def process():
     with open(str(RESULTS_PATH.resolve())) as f:
         results = f.read()
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands_all = json.load(f)
+    # settlements of each unit's islands indexed by their tags,
+    # compiled with the bundle
+    indexes = bundle.matching[SCRIPT_NAME]
 
     # process entries
     new_results = []
@@ -167,73 +298,61 @@ def process():
         # isolate and format settlement names in the entry body
         body_raw = entry.get("body")
         body = [
-            item.strip().split("Ulica:")[0].strip() \
+            Document(item.strip().split("Ulica:")[0].strip()) \
                 for item in body_raw.replace('\n', ' ').split("Mjesto: ") \
                     if item.strip()
         ]
-        
-        # get islands connected to the company unit
-        entry_company_tag = entry.get("company_tag")
-        entry_unit_tag = entry.get("unit_tag")
-        company = next(
-            (
-                item for item in companies if item['tag'] == entry_company_tag
-            ), None
-        )
-        unit = next(
-            (
-                item for item in company.get('units') \
-                    if item['tag'] == entry_unit_tag
-            ), None
-        )
-        islands = unit.get('islands')
+
+        # get the index of the company unit
+        index, matcher = indexes[
+            (entry.get("company_tag"), entry.get("unit_tag"))
+        ]
+
+        entry_external_id = entry.get("external_id")
+        entry_title = entry.get("title")
 
         # check if islands' settlements' tags in entry content
-        for island in islands:
-            # retrieve island's settlements
-            settlements = get_settlement_names_and_tags(islands_all, island)
-            for settlement in settlements:
-                # form a result
-                entry_external_id = entry.get("external_id")
-                entry_title = entry.get("title")
-                locality = settlement.get('name')
-                result = f"{entry_external_id}|{entry_title}|{island}|{locality}"
-                # check tags
-                tags = settlement.get('tags').split(',')
-                for tag in tags:
-                    for item in body:
-                        # sometimes settlement names are grouped in one line
-                        # and separated with a comma
-                        capitalized_tag = re.sub(
-                            r'(\b[a-z])', lambda m: m.group(1).upper(), tag
-                        )
-                        if capitalized_tag in item or tag == item.lower():
-                            # check if result already exists
-                            if result not in results:
-                                new_results.append(result)
+        found = set()
+        for item in body:
+            found |= matcher.match(item.text) | index.get(item.lower)
+
+        # in fuzzy mode also places misspelled or otherwise declined
+        fuzzy = defaultdict(set)
+        for item in body:
+            for settlement_id, hits in index.lookup_fuzzy(
+                [item.lower], exclude=found
+            ).items():
+                fuzzy[settlement_id] |= hits
+        for settlement_id, hits in fuzzy.items():
+            island, locality = bundle.settlements[settlement_id]
+            logger.info(
+                f"[FUZZY HIT] {entry_external_id}|{island}|{locality}|"
+                f"{format_fuzzy_hits(hits)}"
+            )
+        found |= set(fuzzy)
+        for island, locality in bundle.get_settlements(found):
+            # form a result
+            result = f"{entry_external_id}|{entry_title}|{island}|{locality}"
+            # check if result already exists
+            if result not in results:
+                new_results.append(result)
 
     if not new_results:
-        return
+        fetcher.commit()
+        fingerprints.save(keep=is_current)
+        save_poll_policy(poll_policy)
+        checkpoint.finish(fetcher.failed)
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # construct email notifications
     emails = []
     for result in new_results:
         # construct an email message
         external_id, title_raw, island_name, _ = result.split("|")
-        island_label = next(
-            (
-                item.get("label") for item in islands_all \
-                    if item.get("name") == island_name
-            ),
-            ''
-        )
+        island_label = bundle.island_labels.get(island_name, '')
         subject = f'{COMPANY_NAME} | otok {island_label}'
         link = external_id
         title_date = title_raw.replace('Bez struje - ', '').strip()
@@ -245,13 +364,7 @@ def process():
             '</body></html>'.strip()
 
         # collect contacts' emails connected to this island
-        email_addresses = next(
-            (
-                item.get("contacts") for item in contacts \
-                    if item.get("island") == island_name
-            ),
-            []
-        )
+        email_addresses = list(bundle.contacts.get(island_name, ()))
         
         # log what is to be sent
         emails_str = ",".join(email_addresses) if email_addresses \
@@ -270,31 +383,41 @@ def process():
         email_addresses = email[0]
         subject = email[1]
         body = email[2]
-        send_email(email_addresses, subject, body)
+        send_email(email_addresses, subject, body, priority=PRIORITY)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
         for result in new_results:
             f.write(f"{result}\n")
 
-    # write to download file
-    with open(DOWNLOAD_PATH.resolve(), "w+") as f:
-        json.dump(entries, f)
+    # write to download file, unless unchanged since the last run
+    data = json.dumps(entries)
+    digests = Fingerprints(DIGESTS_PATH)
+    if digests.changed(DOWNLOAD_PATH.name, get_fingerprint(data)):
+        with open(DOWNLOAD_PATH.resolve(), "w+") as f:
+            f.write(data)
+
+        # also copy for archiving & debugging purposes
+        shutil.copy(
+            str(DOWNLOAD_PATH.resolve()),
+            str(ARCHIVE_PATH.resolve())
+        )
 
-    # also copy for archiving & debugging purposes
-    shutil.copy(
-        str(DOWNLOAD_PATH.resolve()),
-        str(ARCHIVE_PATH.resolve())
-    )
+    fetcher.commit()
+    digests.save()
+    fingerprints.save(keep=is_current)
+    save_poll_policy(poll_policy)
+    checkpoint.finish(fetcher.failed)
 
-    return
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":
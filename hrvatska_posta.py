@@ -3,15 +3,22 @@ import logging
 import random
 import shutil
 import string
-import sys
-import time
 from datetime import datetime
 from pathlib import Path
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
-from utils import get_email_footer, send_email
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import Document, TagMatcher
+from state import Checkpoint, Fingerprints, SeenLinks, get_fingerprint
+from utils import (
+    PRIORITY_LOW,
+    get_email_footer,
+    get_strainer,
+    send_email,
+    setup_logging,
+)
 
 
 # set constants
@@ -21,54 +28,103 @@ COMPANY_NAME = "Hrvatska pošta"
 SCRIPT_NAME = "hrvatska_posta"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails;
+# units may override it with a "priority" key
+PRIORITY = PRIORITY_LOW
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 60 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 BASE_URL = 'https://www.posta.hr'
 SOURCE_URL = f'{BASE_URL}/aktualne-informacije'
-DOWNLOAD_DELAY_SECONDS = 2
+# stop crawling at the first already processed link;
+# only for listings sorted newest first
+STOP_AT_FIRST_SEEN = False
 INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_PATH = Path(f"{SCRIPT_NAME}/data/data.json")
 ARCHIVE_PATH = Path(f"{SCRIPT_NAME}/data/data_{NOW}_{JOB_ID}.json")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
+SEEN_LINKS_PATH = Path(f"{SCRIPT_NAME}/data/seen_links.json")
+CHECKPOINT_PATH = Path(f"{SCRIPT_NAME}/data/checkpoint.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY_LISTING = get_strainer(('div', {'class': 'ast-articles'}))
+PARSE_ONLY_SUBPAGE = get_strainer(
+    ('h1', {}), ('div', {'class': 'user-content'})
+)
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
+logger = logging.getLogger(SCRIPT_NAME)
+
+
+# scraping
+# --------
+
+def get_listing_url(page):
+    """
+    Returns the URL of a listing page, counting from 1.
+    """
+    if page == 1:
+        return SOURCE_URL
+    return f"{SOURCE_URL}?page={page}"
 
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
 
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
+def scrape_listing(response):
+    """
+    Returns (link, text) pairs of the subpages on a listing page.
+    """
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY_LISTING
+    )
+    div = soup.find('div', {'class': 'ast-articles'})
+    # find and format raw links
+    return [
+        (BASE_URL+item.get("href"), item.text) for item in \
+            div.findChildren("a" , recursive=False)
+    ]
+
 
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+def scrape_subpage(url, response):
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY_SUBPAGE
+    )
+    title = soup.find('h1').text
+    body = soup.find('div', {'class': 'user-content'}).text
+
+    # no discernible information available on source page
+    subtitle = ''
+    published_at = ''
+
+    external_id = url.rpartition('/')[2]
+    link = url
+
+    return {
+        "external_id": external_id,
+        "published_at": published_at,
+        "link": link,
+        "title": title,
+        "subtitle": subtitle,
+        "body": body
+    }
 
 
 # processing
 # ----------
 
-def make_requests(headers, urls):
-    for url in urls:
-        time.sleep(DOWNLOAD_DELAY_SECONDS)
-        try:
-            request = Request(url)
-            for key, value in headers.items(): 
-                request.add_header(key, value)
-            response = urlopen(request).read().decode('utf-8')
-            yield url, response
-        except:
-            logger.error(f"Error downloading data")
-            return
+def compile_matching(bundle):
+    """
+    Returns an automaton of all units' tags, compiled with the bundle;
+    tags are found in lowercased fields as they are.
+    """
+    return TagMatcher(
+        bundle.get_unit_tags(bundle.get_unit_ids(INFRASTRUCTURE_PATH)),
+        normalize=None
+    )
 
 
 def process():
@@ -77,52 +133,47 @@ def process():
         'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)' \
                       'Gecko/20100101 Firefox/53.0'
     }
+    fetcher = Fetcher(logger, headers, cache_path=HTTP_CACHE_PATH)
   
     # make initial request
     urls = [SOURCE_URL]
-    responses = make_requests(headers, urls)
+    responses = fetcher.make_requests(urls, listing=True)
 
     # scrape sub page links
+    listing = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
-        div = soup.find('div', {'class': 'ast-articles'})
-        # find and format raw links
-        links = [
-            BASE_URL+item.get("href") for item in \
-                div.findChildren("a" , recursive=False)
-        ]
+        listing = scrape_listing(response)
+
+    # skip subpages processed on previous runs
+    seen_links = SeenLinks(SEEN_LINKS_PATH)
+    links = seen_links.filter(listing, stop_at_first_seen=STOP_AT_FIRST_SEEN)
+    # new or edited notices adapt polling in daemon mode
+    fetcher.add_changes(len(links))
+
+    # resume subpages processed by an unfinished previous run
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    entries = []
+    for url, restored in checkpoint.restore(links):
+        entries.extend(restored)
+        seen_links.add(url)
 
     # make subpage requests
-    responses = make_requests(headers, links)
+    responses = fetcher.make_requests(checkpoint.pending(links))
 
     # scrape responses & collect entries
-    entries = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
-        title = soup.find('h1').text
-        body = soup.find('div', {'class': 'user-content'}).text
-
-        # no discernible information available on source page
-        subtitle = ''
-        published_at = ''
-
-        external_id = url.rpartition('/')[2]
-        link = url
-
-        entry = {
-            "external_id": external_id,
-            "published_at": published_at,
-            "link": link,
-            "title": title,
-            "subtitle": subtitle,
-            "body": body
-        }
+        entry = scrape_subpage(url, response)
         entries.append(entry)
+        seen_links.add(url)
+        checkpoint.add(url, [entry])
 
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        units = infrastructure.get("units")
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
+    unit_ids = bundle.get_unit_ids(INFRASTRUCTURE_PATH)
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
+
+    # tags of all units, compiled with the bundle
+    matcher = bundle.matching[SCRIPT_NAME]
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -142,40 +193,36 @@ def process():
         title = entry.get("title")
         body = entry.get("body")
         link = entry.get("link")
-        processing_fields = [title, body]
-        for unit in units:
-            unit_name = unit.get("name")
-            unit_tags = unit.get("tags")
+        processing_fields = [Document(title), Document(body)]
+        matched = set()
+        for field in processing_fields:  # process each field
+            # check tags
+            matched |= matcher.match_document(field)
+
+        for unit_id in unit_ids:
+            if unit_id not in matched:
+                continue
+            unit_name = bundle.units[unit_id].get("name")
             result = f"{external_id}|{title}|{unit_name}"
             # check first if there is already a result for this unit
             if result not in results and result not in new_results:
-                unit_tags = unit.get("tags").split(",")
-                for field in processing_fields:  # process each field
-                    # check tags
-                    for tag in unit_tags:
-                        if tag in field.lower():
-                            new_results.append(result)
-                            message_links.append(
-                                {
-                                    "external_id": external_id,
-                                    "link": link
-                                }
-                            )
+                new_results.append(result)
+                message_links.append(
+                    {
+                        "external_id": external_id,
+                        "link": link
+                    }
+                )
 
     if not new_results:
-        return
+        fetcher.commit()
+        seen_links.save()
+        checkpoint.finish(fetcher.failed)
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands = json.load(f)
-
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # send email notifications
     for result in new_results:
         # construct an email message
@@ -187,6 +234,13 @@ def process():
             ),
             ''
         )
+        priority = next(
+            (
+                item.get("priority", PRIORITY) for item in units \
+                    if item.get("name") == unit_name
+            ),
+            PRIORITY
+        )
         subject = f'{COMPANY_NAME} | {unit_label}'
         link = next(
             (
@@ -208,20 +262,8 @@ def process():
             ),
             []
         )
-        emails_all = []
-        # collect contacts' emails connected to this island
-        for island in islands:
-            emails = next(
-                (
-                    item.get("contacts") for item in contacts \
-                        if item.get("island") == island
-                ),
-                []
-            )
-            emails_all.extend(emails)
-
-        # remove duplicate emails
-        emails_all = list(set(emails_all))
+        # collect contacts' emails connected to these islands
+        emails_all = list(bundle.get_emails(islands))
         
         # log what is to be sent
         emails_str = ",".join(emails_all) if emails_all \
@@ -232,31 +274,40 @@ def process():
         )
 
         # send emails
-        send_email(emails_all, subject, body)
+        send_email(emails_all, subject, body, priority=priority)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
         for result in new_results:
             f.write(f"{result}\n")
 
-    # write to download file
-    with open(DOWNLOAD_PATH.resolve(), "w+") as f:
-        json.dump(entries, f)
+    # write to download file, unless unchanged since the last run
+    data = json.dumps(entries)
+    digests = Fingerprints(DIGESTS_PATH)
+    if digests.changed(DOWNLOAD_PATH.name, get_fingerprint(data)):
+        with open(DOWNLOAD_PATH.resolve(), "w+") as f:
+            f.write(data)
+
+        # also copy for archiving & debugging purposes
+        shutil.copy(
+            str(DOWNLOAD_PATH.resolve()),
+            str(ARCHIVE_PATH.resolve())
+        )
 
-    # also copy for archiving & debugging purposes
-    shutil.copy(
-        str(DOWNLOAD_PATH.resolve()),
-        str(ARCHIVE_PATH.resolve())
-    )
+    fetcher.commit()
+    digests.save()
+    seen_links.save()
+    checkpoint.finish(fetcher.failed)
 
-    return
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":
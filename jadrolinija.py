@@ -3,22 +3,31 @@ import json
 import logging
 import random
 import shutil
-import ssl
 import string
-import sys
-import time
-import unicodedata
 from datetime import datetime
 from pathlib import Path
-from urllib.request import Request, urlopen
 from xml.etree import ElementTree as ET
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import TagMatcher, match_units
+from state import (
+    Checkpoint,
+    Fingerprints,
+    SeenLinks,
+    get_fingerprint,
+    load_state,
+    save_state,
+)
 from utils import (
+    PRIORITY_HIGH,
     get_email_footer,
+    get_strainer,
     send_email,
-    contains_variant
+    normalize_for_match,
+    setup_logging,
 )
 
 
@@ -29,76 +38,94 @@ COMPANY_NAME = "Jadrolinija"
 SCRIPT_NAME = "jadrolinija"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails;
+# units may override it with a "priority" key
+PRIORITY = PRIORITY_HIGH
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 5 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 SOURCE_URL_FEED = "https://www.jadrolinija.hr/feeds/vijesti"
 SOURCE_URL_SITE = "https://www.jadrolinija.hr/hr/obavijesti-za-putnike"
-DOWNLOAD_DELAY_SECONDS = 2
+# the source's certificate chain doesn't verify, so skip verification
+VERIFY_SSL = False
+# stop crawling at the first already processed link;
+# only for listings sorted newest first
+STOP_AT_FIRST_SEEN = False
 INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_FEED_PATH = Path(f"{SCRIPT_NAME}/data/feed.xml")
 ARCHIVE_FEED_PATH = Path(f"{SCRIPT_NAME}/data/feed_{NOW}_{JOB_ID}.xml")
 DOWNLOAD_SITE_PATH = Path(f"{SCRIPT_NAME}/data/data.json")
 ARCHIVE_SITE_PATH = Path(f"{SCRIPT_NAME}/data/data_{NOW}_{JOB_ID}.json")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
+FEED_NOTICES_PATH = Path(f"{SCRIPT_NAME}/data/feed_notices.json")
+# number of feed notices remembered after they drop off the feed
+FEED_NOTICES_MAX = 500
+SEEN_LINKS_PATH = Path(f"{SCRIPT_NAME}/data/seen_links.json")
+CHECKPOINT_PATH = Path(f"{SCRIPT_NAME}/data/checkpoint.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY_LISTING = get_strainer(('ul', {'class': 'press__list'}))
+PARSE_ONLY_SUBPAGE = get_strainer(
+    ('h1', {}), ('h2', {}), ('div', {'class': 'wysiwyg'})
+)
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
-
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
-
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
-
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+logger = logging.getLogger(SCRIPT_NAME)
 
 
 # processing
 # ----------
 
-def make_requests(headers, urls):
-    for url in urls:
-        time.sleep(DOWNLOAD_DELAY_SECONDS)
-        try:
-            context = ssl._create_unverified_context()
-            request = Request(url)
-            for key, value in headers.items(): 
-                request.add_header(key, value)
-            response = urlopen(request, context=context).read().decode('utf-8')
-            yield url, response
-        except:
-            logger.error(f"Error downloading data")
-            return
+def get_notice_fingerprint(entry):
+    """
+    Identifies a notice by its title and body, whether it's read from
+    the feed or from the site.
+    """
+    return get_fingerprint(
+        f"{normalize_for_match(entry['title'])}|"
+        f"{normalize_for_match(entry['body'])}"
+    )
+
+
+def compile_matching(bundle):
+    """
+    Returns an automaton of all units' tags, compiled with the bundle.
+    """
+    return TagMatcher(
+        bundle.get_unit_tags(bundle.get_unit_ids(INFRASTRUCTURE_PATH))
+    )
 
 
 def process():
     # process the RSS feed
     # --------------------
 
-    # download the data
+    # prepare headers
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4_1) ' \
+                      'AppleWebKit/605.1.15 (KHTML, like Gecko) ' \
+                      'Version/17.4.1 Safari/605.1.15'
+    }
+
+    fetcher = Fetcher(
+        logger, headers, cache_path=HTTP_CACHE_PATH, verify=VERIFY_SSL
+    )
+
+    # download the data;
+    # no response if the feed didn't change since the last run;
+    # carry on with the site if the feed fails
     try:
-        context = ssl._create_unverified_context()
-        with urlopen(SOURCE_URL_FEED, context=context) as r:
-            response_feed = r.read()
+        response_feed = fetcher.fetch(SOURCE_URL_FEED)
     except:
-        logger.error(f"Error downloading data")
-        return
-
-    # create a download file it doesn't exist
-    if not DOWNLOAD_FEED_PATH.exists():
-        f = DOWNLOAD_FEED_PATH.open("wb+")
-        f.close()
+        logger.error(f"Error downloading data: {SOURCE_URL_FEED}")
+        fetcher.fail(SOURCE_URL_FEED)
+        response_feed = None
 
     # # check if new downloaded data available
     # f = DOWNLOAD_FEED_PATH.open("rb")
@@ -107,10 +134,9 @@ def process():
     # if existing_data == response:
     #     return
     
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        units = infrastructure.get("units")
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
 
     # create a results file if it doesn't exist
     if not RESULTS_PATH.exists():
@@ -122,44 +148,77 @@ def process():
         results = f.read()
 
     # process XML response & entries
-    tree = ET.ElementTree(ET.fromstring(response_feed))
-    root = tree.getroot()
-    entries_feed = root.findall('.//channel/item')
+    entries_feed = []
+    if response_feed is not None:
+        tree = ET.ElementTree(ET.fromstring(response_feed))
+        root = tree.getroot()
+        for item in root.findall('.//channel/item'):
+            entries_feed.append({
+                "external_id": item.findtext("guid", default=""),
+                "title": html.unescape(item.findtext("title", default="")),
+                "subtitle": html.unescape(
+                    item.findtext("description", default="")
+                ),
+                "body": html.unescape(
+                    item.findtext(
+                        "{http://www.w3.org/2005/Atom}content", default=""
+                    )
+                ),
+                # # not used / unreliable in the feed
+                # "published_at": item.findtext("pubDate", default=""),
+            })
 
-    if not entries_feed:
-        entries_feed = []
+    # remember notices the feed covers, also after they drop off the feed,
+    # so the site doesn't notify about them again
+    feed_notices = load_state(FEED_NOTICES_PATH, dict())
+    for entry in entries_feed:
+        fingerprint = get_notice_fingerprint(entry)
+        # new feed notices adapt polling in daemon mode
+        fetcher.add_changes(fingerprint not in feed_notices)
+        feed_notices[fingerprint] = normalize_for_match(entry["title"])
+    feed_notices = dict(list(feed_notices.items())[-FEED_NOTICES_MAX:])
 
     # process the site
     # ----------------
 
-    # prepare headers
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4_1) ' \
-                      'AppleWebKit/605.1.15 (KHTML, like Gecko) ' \
-                      'Version/17.4.1 Safari/605.1.15'
-    }
-  
     # make initial request
     urls = [SOURCE_URL_SITE]
-    responses = make_requests(headers, urls)
+    responses = fetcher.make_requests(urls, listing=True)
 
     # scrape sub page links
+    listing = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
+        soup = BeautifulSoup(
+            response, 'html.parser', parse_only=PARSE_ONLY_LISTING
+        )
         ul = soup.find('ul', {'class': 'press__list'})
         # find links
-        links = [
-            item.get("href") for item in \
+        listing = [
+            (item.get("href"), item.text) for item in \
                 ul.findChildren("a" , recursive=True)
         ]
 
+    # skip subpages processed on previous runs
+    seen_links = SeenLinks(SEEN_LINKS_PATH)
+    links = seen_links.filter(listing, stop_at_first_seen=STOP_AT_FIRST_SEEN)
+    # new or edited notices adapt polling in daemon mode
+    fetcher.add_changes(len(links))
+
+    # resume subpages processed by an unfinished previous run
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    entries_site = []
+    for url, restored in checkpoint.restore(links):
+        entries_site.extend(restored)
+        seen_links.add(url)
+
     # make subpage requests
-    responses = make_requests(headers, links)
+    responses = fetcher.make_requests(checkpoint.pending(links))
 
     # scrape responses & collect entries
-    entries_site = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
+        soup = BeautifulSoup(
+            response, 'html.parser', parse_only=PARSE_ONLY_SUBPAGE
+        )
         external_id = url.rpartition('/')[2]
         title = soup.find('h1').text
         subtitle = soup.find('h2').text
@@ -179,98 +238,64 @@ def process():
             "subtitle": subtitle,
             "body": body
         }
+        seen_links.add(url)
+
+        # skip notices the feed covers by title and body; titles alone
+        # are reused for new notices, so each subpage is fetched once
+        if get_notice_fingerprint(entry) in feed_notices:
+            checkpoint.add(url, [])
+            continue
+
         entries_site.append(entry)
+        checkpoint.add(url, [entry])
 
     # continue with further processing
     # --------------------------------
 
+    # merge feed and site entries, each notice once
+    entries = dict()
+    for entry in entries_feed + entries_site:
+        entries.setdefault(get_notice_fingerprint(entry), entry)
+
     new_results = []
-    
-    # check for new results in the RSS feed data
-    for entry in entries_feed:
-        # parse XML entry data
-        external_id = entry.findtext("guid", default="")
-        title = html.unescape(entry.findtext("title", default=""))
-        subtitle = html.unescape(entry.findtext("description", default=""))
-        body = html.unescape(
-            entry.findtext("{http://www.w3.org/2005/Atom}content", default="")
-        )
-        # # not used / unreliable in the feed
-        # published_at = entry.findtext("pubDate", default="")
-        
-        # compare XML entry data with results data
-        processing_fields = [
-            title, subtitle, body
-        ] 
-        for unit in units:
-            unit_name = unit.get("name")
-            result = f"{external_id}|{title}|{unit_name}"
-            # check first if there is already a result for this unit
-            if result not in results and result not in new_results:
-                unit_tags = unit.get("tags").split(",")
-                for field in processing_fields:  # process each field
-                    # &nbsp; turns into \xa0 when splitting and
-                    # slavic alphabet characters are not parsed correctly,
-                    # so we normalize first
-                    field_value = unicodedata.normalize(
-                        "NFKC", field.lower()
-                    )
-                    # find unit name and tags in field value;
-                    # use unit name (a number) as a separate tag
-                    # due to mixing with other numbers in value -
-                    # sorted by splitting field value by space
-                    if unit_name in field_value.split(" "):
-                        new_results.append(result)
-                    for tag in unit_tags:
-                        if contains_variant(field.lower(), tag):
-                        # if tag in field.lower():
-                            new_results.append(result)
-
-    # check for new results in the site data
-    for entry in entries_site:
-        # compare entry data with results data
+
+    # tags of all units, matched in a single pass over each field;
+    # unit names (numbers) are also matched as separate words,
+    # due to mixing with other numbers in fields
+    matcher = bundle.matching[SCRIPT_NAME]
+    names = bundle.get_unit_name_ids(bundle.get_unit_ids(INFRASTRUCTURE_PATH))
+
+    # check for new results in the entries
+    for entry in entries.values():
         external_id = entry.get("external_id")
         title = entry.get("title")
-        body = entry.get("body")
-        
-        # compare the site entry data with results data
+
+        # compare entry data with results data
         processing_fields = [
-            title, subtitle, body
-        ] 
+            title, entry.get("subtitle"), entry.get("body")
+        ]
+        matched = bundle.get_unit_names(
+            match_units(processing_fields, matcher, names)
+        )
+
         for unit in units:
             unit_name = unit.get("name")
             result = f"{external_id}|{title}|{unit_name}"
             # check first if there is already a result for this unit
-            if result not in results and result not in new_results:
-                unit_tags = unit.get("tags").split(",")
-                for field in processing_fields:  # process each field
-                    # &nbsp; turns into \xa0 when splitting and
-                    # slavic alphabet characters are not parsed correctly,
-                    # so we normalize first
-                    field_value = unicodedata.normalize(
-                        "NFKC", field.lower()
-                    )
-                    # find unit name and tags in field value;
-                    # use unit name (a number) as a separate tag
-                    # due to mixing with other numbers in value -
-                    # sorted by splitting field value by space
-                    if unit_name in field_value.split(" "):
-                        new_results.append(result)
-                    for tag in unit_tags:
-                        if contains_variant(field.lower(), tag):
-                        # if tag in field.lower():
-                            new_results.append(result)
+            if unit_name in matched and result not in results \
+                    and result not in new_results:
+                new_results.append(result)
 
     if not new_results:
-        return
+        fetcher.commit()
+        seen_links.save()
+        save_state(FEED_NOTICES_PATH, feed_notices)
+        checkpoint.finish(fetcher.failed)
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # send email notifications
     for result in new_results:
         # construct an email message
@@ -282,6 +307,13 @@ def process():
             ),
             ''
         )
+        priority = next(
+            (
+                item.get("priority", PRIORITY) for item in units \
+                    if item.get("name") == unit_name
+            ),
+            PRIORITY
+        )
         subject = f'{COMPANY_NAME} | {unit_label}'
         if 'urn:uuid' in external_id:
             body = f'<!DOCTYPE html><html><body><p>{title}</p><br>'\
@@ -304,20 +336,8 @@ def process():
             ),
             []
         )
-        emails_all = []
-        # collect contacts' emails connected to this island
-        for island in islands:
-            emails = next(
-                (
-                    item.get("contacts") for item in contacts \
-                        if item.get("island") == island
-                ),
-                []
-            )
-            emails_all.extend(emails)
-
-        # remove duplicate emails
-        emails_all = list(set(emails_all))
+        # collect contacts' emails connected to these islands
+        emails_all = list(bundle.get_emails(islands))
         
         # log what is to be sent
         emails_str = ",".join(emails_all) if emails_all \
@@ -328,40 +348,53 @@ def process():
         )
 
         # send emails
-        send_email(emails_all, subject, body)
+        send_email(emails_all, subject, body, priority=priority)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
         for result in new_results:
             f.write(f"{result}\n")
 
-    # write to download files
-    f = DOWNLOAD_FEED_PATH.open("wb+")
-    f.write(response_feed)
-    f.close()
+    # write to download files, unless unchanged since the last run;
+    # also copy for archiving & debugging purposes
+    digests = Fingerprints(DIGESTS_PATH)
+    if response_feed is not None and digests.changed(
+        DOWNLOAD_FEED_PATH.name, fetcher.digests[SOURCE_URL_FEED]
+    ):
+        f = DOWNLOAD_FEED_PATH.open("wb+")
+        f.write(response_feed)
+        f.close()
 
-    with open(DOWNLOAD_SITE_PATH.resolve(), "w+") as f:
-        json.dump(entries_site, f)
+        shutil.copy(
+            str(DOWNLOAD_FEED_PATH.resolve()),
+            str(ARCHIVE_FEED_PATH.resolve())
+        )
 
-    # also copy for archiving & debugging purposes
-    shutil.copy(
-        str(DOWNLOAD_FEED_PATH.resolve()),
-        str(ARCHIVE_FEED_PATH.resolve())
-    )
+    data_site = json.dumps(entries_site)
+    if digests.changed(DOWNLOAD_SITE_PATH.name, get_fingerprint(data_site)):
+        with open(DOWNLOAD_SITE_PATH.resolve(), "w+") as f:
+            f.write(data_site)
 
-    shutil.copy(
-        str(DOWNLOAD_SITE_PATH.resolve()),
-        str(ARCHIVE_SITE_PATH.resolve())
-    )
+        shutil.copy(
+            str(DOWNLOAD_SITE_PATH.resolve()),
+            str(ARCHIVE_SITE_PATH.resolve())
+        )
+
+    fetcher.commit()
+    digests.save()
+    seen_links.save()
+    save_state(FEED_NOTICES_PATH, feed_notices)
+    checkpoint.finish(fetcher.failed)
 
-    return
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":
@@ -1,21 +1,28 @@
 import json
 import logging
 import random
-import re
 import shutil
 import string
-import sys
-import time
 from datetime import datetime
 from pathlib import Path
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import (
+    Document,
+    SettlementIndex,
+    capitalize_tag,
+    format_fuzzy_hits,
+)
+from state import Checkpoint, Fingerprints, SeenLinks, get_fingerprint
 from utils import (
+    PRIORITY_NORMAL,
     get_email_footer,
-    get_settlement_names_and_tags,
+    get_strainer,
     send_email,
+    setup_logging,
 )
 
 
@@ -26,54 +33,106 @@ COMPANY_NAME = "Komunalac Biograd na Moru"
 SCRIPT_NAME = "komunalac_bnm"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails
+PRIORITY = PRIORITY_NORMAL
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 30 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 BASE_URL = 'https://www.komunalac.com'
 SOURCE_URL = f'{BASE_URL}/obavijesti'
-DOWNLOAD_DELAY_SECONDS = 1
+# stop crawling at the first already processed link;
+# only for listings sorted newest first
+STOP_AT_FIRST_SEEN = False
 INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_PATH = Path(f"{SCRIPT_NAME}/data/data.json")
 ARCHIVE_PATH = Path(f"{SCRIPT_NAME}/data/data_{NOW}_{JOB_ID}.json")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
+SEEN_LINKS_PATH = Path(f"{SCRIPT_NAME}/data/seen_links.json")
+CHECKPOINT_PATH = Path(f"{SCRIPT_NAME}/data/checkpoint.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY_LISTING = get_strainer(('div', {'class': 'news-list'}))
+PARSE_ONLY_SUBPAGE = get_strainer(
+    ('h1', {}), ('div', {'class': 'content'})
+)
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
+logger = logging.getLogger(SCRIPT_NAME)
+
+
+# scraping
+# --------
+
+def get_listing_url(page):
+    """
+    Returns the URL of a listing page, counting from 1.
+    """
+    if page == 1:
+        return SOURCE_URL
+    return f"{SOURCE_URL}?page={page}"
 
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
 
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
+def scrape_listing(response):
+    """
+    Returns (link, text) pairs of the subpages on a listing page.
+    """
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY_LISTING
+    )
+    div = soup.find('div', {'class': 'news-list'})
+    # find and format raw links
+    return [
+        (BASE_URL+item.get("href"), item.text) for item in \
+            div.findChildren("a" , recursive=True)
+    ]
+
 
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+def scrape_subpage(url, response):
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY_SUBPAGE
+    )
+    title = soup.find('h1').text
+    body = soup.find('div', {'class': 'content'}).text
+
+    # no discernible information available on source page
+    subtitle = ''
+    published_at = ''
+
+    external_id = url.rpartition('/')[2]
+    link = url
+
+    return {
+        "external_id": external_id,
+        "published_at": published_at,
+        "link": link,
+        "title": title,
+        "subtitle": subtitle,
+        "body": body
+    }
 
 
 # processing
 # ----------
 
-def make_requests(headers, urls):
-    for url in urls:
-        time.sleep(DOWNLOAD_DELAY_SECONDS)
-        try:
-            request = Request(url)
-            for key, value in headers.items(): 
-                request.add_header(key, value)
-            response = urlopen(request).read().decode('utf-8')
-            yield url, response
-        except:
-            logger.error(f"Error downloading data")
-            return
+def compile_matching(bundle):
+    """
+    Returns the source's settlement index, compiled with the bundle.
+    """
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
+
+    # index settlements of the islands connected to the singular
+    # company unit by their tags, capitalized and uppercased,
+    # for ex. m.iž > M.Iž, staroj novalji > Staroj Novalji, žman > ŽMAN
+    return SettlementIndex(
+        bundle.get_settlement_tags(units[0].get('islands')),
+        forms=(capitalize_tag, str.upper)
+    )
 
 
 def process():
@@ -82,59 +141,45 @@ def process():
         'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)' \
                       'Gecko/20100101 Firefox/53.0'
     }
+    fetcher = Fetcher(logger, headers, cache_path=HTTP_CACHE_PATH)
   
     # make initial request
     urls = [SOURCE_URL]
-    responses = make_requests(headers, urls)
+    responses = fetcher.make_requests(urls, listing=True)
 
     # scrape sub page links
+    listing = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
-        div = soup.find('div', {'class': 'news-list'})
-        # find and format raw links
-        links = [
-            BASE_URL+item.get("href") for item in \
-                div.findChildren("a" , recursive=True)
-        ]
+        listing = scrape_listing(response)
 
     # limit to last 8 links
-    links = links[:8]
+    listing = listing[:8]
+
+    # skip subpages processed on previous runs
+    seen_links = SeenLinks(SEEN_LINKS_PATH)
+    links = seen_links.filter(listing, stop_at_first_seen=STOP_AT_FIRST_SEEN)
+    # new or edited notices adapt polling in daemon mode
+    fetcher.add_changes(len(links))
+
+    # resume subpages processed by an unfinished previous run
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    entries = []
+    for url, restored in checkpoint.restore(links):
+        entries.extend(restored)
+        seen_links.add(url)
 
     # make subpage requests
-    responses = make_requests(headers, links)
+    responses = fetcher.make_requests(checkpoint.pending(links))
 
     # scrape responses & collect entries
-    entries = []
     for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
-        title = soup.find('h1').text
-        body = soup.find('div', {'class': 'content'}).text
-
-        # no discernible information available on source page
-        subtitle = ''
-        published_at = ''
-
-        external_id = url.rpartition('/')[2]
-        link = url
-
-        entry = {
-            "external_id": external_id,
-            "published_at": published_at,
-            "link": link,
-            "title": title,
-            "subtitle": subtitle,
-            "body": body
-        }
+        entry = scrape_subpage(url, response)
         entries.append(entry)
+        seen_links.add(url)
+        checkpoint.add(url, [entry])
 
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        units = infrastructure.get("units")
-
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands_all = json.load(f)
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -145,73 +190,45 @@ def process():
     with open(str(RESULTS_PATH.resolve())) as f:
         results = f.read()
 
+    # settlements indexed by their tags, compiled with the bundle
+    index = bundle.matching[SCRIPT_NAME]
+
     # process entries
     new_results = []
     for entry in entries:
-        body_raw = entry.get("body").strip().replace(
-            '\n', ' '
-        ).replace(
-            '\xa0', ' '
-        ).replace(
-            ',', ' '
-        ).replace(
-            ';', ' '
-        ).replace(
-            ':', ' '
-        )
-        body = [
-            item.strip() for item in body_raw.split(' ') if item.strip()
-        ]
         # check for last characters, for ex. Jezera. > Jezera
-        body = [item[:-1] if item[-1:] in ['.', '-', '–'] else item for item in body]
-        
-        # get islands connected to the singular company unit
-        unit = units[0]
-        islands = unit.get('islands')
-
-        # check if islands' settlements' tags in entry content
-        for island in islands:
-            # retrieve island's settlements
-            settlements = get_settlement_names_and_tags(islands_all, island)
-            for settlement in settlements:
-                # form a result
-                locality = settlement.get('name')
-                external_id = entry.get('external_id').strip()
-                title = entry.get('title').strip()
-                result = f"{external_id}|{title}|{island}|{locality}"
-                # check tags
-                tags = settlement.get('tags').split(',')
-                for tag in tags:
-                    # capitalize the tag
-                    # for ex. m.iž > M.Iž
-                    # for ex. staroj novalji > Staroj Novalji
-                    capitalized_tag = re.sub(
-                        r'(\b[a-z])', lambda m: m.group(1).upper(), tag
-                    )
-                    # uppercase the tag
-                    # for ex. žman > ŽMAN
-                    uppercase_tag = tag.upper()
-                    # print(">", capitalized_tag)
-                    # print(">", uppercase_tag)
-                    if capitalized_tag in body or uppercase_tag in body:
-                        # check if result already exists
-                        if result not in results:
-                            new_results.append(result)
+        body = Document(entry.get("body")).stripped_token_list
+        external_id = entry.get('external_id').strip()
+        title = entry.get('title').strip()
+
+        # check if islands' settlements' tags in entry content,
+        # in fuzzy mode also misspelled or otherwise declined
+        found = set(index.lookup(body))
+        fuzzy = index.lookup_fuzzy(body, exclude=found)
+        for settlement_id, hits in fuzzy.items():
+            island, locality = bundle.settlements[settlement_id]
+            logger.info(
+                f"[FUZZY HIT] {external_id}|{island}|{locality}|"
+                f"{format_fuzzy_hits(hits)}"
+            )
+        found |= set(fuzzy)
+
+        for island, locality in bundle.get_settlements(found):
+            # form a result
+            result = f"{external_id}|{title}|{island}|{locality}"
+            # check if result already exists
+            if result not in results:
+                new_results.append(result)
 
     if not new_results:
-        return
+        fetcher.commit()
+        seen_links.save()
+        checkpoint.finish(fetcher.failed)
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands = json.load(f)
-
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # construct email notifications
     emails = []
     for result in new_results:
@@ -225,13 +242,7 @@ def process():
             '</body></html>'.strip()
 
         # collect contacts' emails connected to this island
-        email_addresses = next(
-            (
-                item.get("contacts") for item in contacts \
-                    if item.get("island") == island_name
-            ),
-            []
-        )
+        email_addresses = list(bundle.contacts.get(island_name, ()))
         
         # log what is to be sent
         emails_str = ",".join(email_addresses) if email_addresses \
@@ -250,31 +261,40 @@ def process():
         email_addresses = email[0]
         subject = email[1]
         body = email[2]
-        send_email(email_addresses, subject, body)
+        send_email(email_addresses, subject, body, priority=PRIORITY)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
         for result in new_results:
             f.write(f"{result}\n")
 
-    # write to download file
-    with open(DOWNLOAD_PATH.resolve(), "w+") as f:
-        json.dump(entries, f)
+    # write to download file, unless unchanged since the last run
+    data = json.dumps(entries)
+    digests = Fingerprints(DIGESTS_PATH)
+    if digests.changed(DOWNLOAD_PATH.name, get_fingerprint(data)):
+        with open(DOWNLOAD_PATH.resolve(), "w+") as f:
+            f.write(data)
+
+        # also copy for archiving & debugging purposes
+        shutil.copy(
+            str(DOWNLOAD_PATH.resolve()),
+            str(ARCHIVE_PATH.resolve())
+        )
 
-    # also copy for archiving & debugging purposes
-    shutil.copy(
-        str(DOWNLOAD_PATH.resolve()),
-        str(ARCHIVE_PATH.resolve())
-    )
+    fetcher.commit()
+    digests.save()
+    seen_links.save()
+    checkpoint.finish(fetcher.failed)
 
-    return
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":
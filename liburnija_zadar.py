@@ -1,22 +1,30 @@
 import json
 import logging
 import random
-import re
 import shutil
 import string
-import sys
-import time
 from datetime import datetime
 from pathlib import Path
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import (
+    Document,
+    SettlementIndex,
+    capitalize_tag,
+    format_fuzzy_hits,
+)
+from state import Fingerprints, get_fingerprint
 from utils import (
+    PRIORITY_NORMAL,
     get_email_footer,
-    get_settlement_names_and_tags,
+    get_strainer,
     send_email,
+    setup_logging,
 )
+from wordpress import WordPressPosts
 
 
 # set constants
@@ -26,75 +34,58 @@ COMPANY_NAME = "Liburnija Zadar"
 SCRIPT_NAME = "liburnija_zadar"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails
+PRIORITY = PRIORITY_NORMAL
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 30 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 BASE_URL = 'https://liburnija-zadar.hr/'
 SOURCE_URL = f'{BASE_URL}/novosti/'
-DOWNLOAD_DELAY_SECONDS = 1
+# read posts through the WordPress REST API, falling back to scraping
+# the site if it isn't available
+USE_WORDPRESS_API = True
 INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_PATH = Path(f"{SCRIPT_NAME}/data/data.json")
 ARCHIVE_PATH = Path(f"{SCRIPT_NAME}/data/data_{NOW}_{JOB_ID}.json")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+WORDPRESS_STATE_PATH = Path(f"{SCRIPT_NAME}/data/wordpress.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY = get_strainer(('div', {'class': 'av-masonry-container'}))
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
-
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
-
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
+logger = logging.getLogger(SCRIPT_NAME)
 
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
 
+# scraping
+# --------
 
-# processing
-# ----------
-
-def make_requests(headers, urls):
-    for url in urls:
-        time.sleep(DOWNLOAD_DELAY_SECONDS)
-        try:
-            request = Request(url)
-            for key, value in headers.items(): 
-                request.add_header(key, value)
-            response = urlopen(request).read().decode('utf-8')
-            yield url, response
-        except:
-            logger.error(f"Error downloading data")
-            return
+def get_listing_url(page):
+    """
+    Returns the URL of a listing page, counting from 1.
+    """
+    if page == 1:
+        return SOURCE_URL
+    # the masonry element's own pagination
+    return f"{SOURCE_URL}?avia-element-paging={page}"
 
 
-def process():
-    # prepare headers
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)' \
-                      'Gecko/20100101 Firefox/53.0'
-    }
-  
-    # make initial request
-    urls = [SOURCE_URL]
-    responses = make_requests(headers, urls)
-
-    # scrape response
-    for url, response in responses:
-        soup = BeautifulSoup(response, 'html.parser')
-        div = soup.find('div', {'class': 'av-masonry-container'})
-        elements = div.findChildren("a" , recursive=True)
-
-    # limit to last 8 elements
-    elements = elements[:8]
+def scrape_entries(response):
+    """
+    Returns entries of the posts on a listing page, which has no subpages
+    to scrape.
+    """
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY
+    )
+    div = soup.find('div', {'class': 'av-masonry-container'})
+    elements = div.findChildren("a" , recursive=True)
 
     entries = []
     for element in elements:
@@ -117,14 +108,73 @@ def process():
         }
         entries.append(entry)
 
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        units = infrastructure.get("units")
+    return entries
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands_all = json.load(f)
+
+# processing
+# ----------
+
+def scrape_site(fetcher):
+    """
+    Scrapes entries of the latest posts from the site's news page.
+    """
+    # make initial request
+    urls = [SOURCE_URL]
+    responses = fetcher.make_requests(urls, listing=True)
+
+    # scrape response
+    entries = []
+    for url, response in responses:
+        entries = scrape_entries(response)
+
+    # limit to last 8 elements
+    return entries[:8]
+
+
+def compile_matching(bundle):
+    """
+    Returns the source's settlement index, compiled with the bundle.
+    """
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
+
+    # index settlements of the islands connected to the company units
+    # by their tags, capitalized and uppercased,
+    # for ex. m.iž > M.Iž, staroj novalji > Staroj Novalji, žman > ŽMAN
+    return SettlementIndex(
+        bundle.get_settlement_tags(
+            dict.fromkeys(
+                island for unit in units for island in unit.get('islands')
+            )
+        ),
+        forms=(capitalize_tag, str.upper)
+    )
+
+
+def process():
+    # prepare headers
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)' \
+                      'Gecko/20100101 Firefox/53.0'
+    }
+    fetcher = Fetcher(logger, headers, cache_path=HTTP_CACHE_PATH)
+
+    # read new posts through the WordPress API, or scrape the site
+    posts = WordPressPosts(fetcher, BASE_URL, WORDPRESS_STATE_PATH)
+    digests = Fingerprints(DIGESTS_PATH)
+    entries = posts.get() if USE_WORDPRESS_API else None
+    if entries is None:
+        entries = scrape_site(fetcher)
+        # the latest posts are scraped on every run, so only changed
+        # posts adapt polling in daemon mode
+        fetcher.add_changes(
+            digests.changed("site", get_fingerprint(json.dumps(entries)))
+        )
+    else:
+        # new or modified posts adapt polling in daemon mode
+        fetcher.add_changes(len(entries))
+
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -135,75 +185,44 @@ def process():
     with open(str(RESULTS_PATH.resolve())) as f:
         results = f.read()
 
+    # settlements indexed by their tags, compiled with the bundle
+    index = bundle.matching[SCRIPT_NAME]
+
     # process entries
     new_results = []
     for entry in entries:
-        title_raw = entry.get("title").strip().replace(
-            '\n', ' '
-        ).replace(
-            '-', ' '
-        ).replace(
-            ',', ' '
-        ).replace(
-            ';', ' '
-        ).replace(
-            ':', ' '
-        ).replace(
-            '“', ' '
-        ).replace(
-            '”', ' '
-        )
-        title = [
-            item.strip() for item in title_raw.split(' ') if item.strip()
-        ]
-        # check for last characters, for ex. Vir. > Vir
-        body = [item[:-1] if item[-1:] in ['.', '-', '–'] else item for item in body]
-        
-        # get islands connected to the company units
-        for unit in units:
-            islands = unit.get('islands')
-            # check if islands' settlements' tags in entry content
-            for island in islands:
-                # retrieve island's settlements
-                settlements = get_settlement_names_and_tags(islands_all, island)
-                for settlement in settlements:
-                    # form a result
-                    locality = settlement.get('name')
-                    external_id = entry.get('external_id')
-                    result = f"{external_id}|{title_raw}|{island}|{locality}"
-                    # check tags
-                    tags = settlement.get('tags').split(',')
-                    for tag in tags:
-                        # capitalize the tag
-                        # for ex. m.iž > M.Iž
-                        # for ex. staroj novalji > Staroj Novalji
-                        capitalized_tag = re.sub(
-                            r'(\b[a-z])', lambda m: m.group(1).upper(), tag
-                        )
-                        # uppercase the tag
-                        # for ex. žman > ŽMAN
-                        uppercase_tag = tag.upper()
-                        # print(">", capitalized_tag)
-                        # print(">", uppercase_tag)
-                        if capitalized_tag in title or uppercase_tag in title:
-                            # check if result already exists
-                            if result not in results:
-                                new_results.append(result)
+        document = Document(entry.get("title"), separators="\n-,;:“”")
+        title_raw = document.spaced
+        external_id = entry.get('external_id')
+
+        # check if islands' settlements' tags in entry content,
+        # in fuzzy mode also misspelled or otherwise declined
+        found = set(index.lookup(document.token_list))
+        fuzzy = index.lookup_fuzzy(document.token_list, exclude=found)
+        for settlement_id, hits in fuzzy.items():
+            island, locality = bundle.settlements[settlement_id]
+            logger.info(
+                f"[FUZZY HIT] {external_id}|{island}|{locality}|"
+                f"{format_fuzzy_hits(hits)}"
+            )
+        found |= set(fuzzy)
+
+        for island, locality in bundle.get_settlements(found):
+            # form a result
+            result = f"{external_id}|{title_raw}|{island}|{locality}"
+            # check if result already exists
+            if result not in results:
+                new_results.append(result)
 
     if not new_results:
-        return
+        fetcher.commit()
+        posts.save()
+        digests.save()
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands = json.load(f)
-
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # construct email notifications
     emails = []
     for result in new_results:
@@ -217,13 +236,7 @@ def process():
             '</body></html>'.strip()
 
         # collect contacts' emails connected to this island
-        email_addresses = next(
-            (
-                item.get("contacts") for item in contacts \
-                    if item.get("island") == island_name
-            ),
-            []
-        )
+        email_addresses = list(bundle.contacts.get(island_name, ()))
         
         # log what is to be sent
         emails_str = ",".join(email_addresses) if email_addresses \
@@ -242,31 +255,38 @@ def process():
         email_addresses = email[0]
         subject = email[1]
         body = email[2]
-        send_email(email_addresses, subject, body)
+        send_email(email_addresses, subject, body, priority=PRIORITY)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
         for result in new_results:
             f.write(f"{result}\n")
 
-    # write to download file
-    with open(DOWNLOAD_PATH.resolve(), "w+") as f:
-        json.dump(entries, f)
+    # write to download file, unless unchanged since the last run
+    data = json.dumps(entries)
+    if digests.changed(DOWNLOAD_PATH.name, get_fingerprint(data)):
+        with open(DOWNLOAD_PATH.resolve(), "w+") as f:
+            f.write(data)
 
-    # also copy for archiving & debugging purposes
-    shutil.copy(
-        str(DOWNLOAD_PATH.resolve()),
-        str(ARCHIVE_PATH.resolve())
-    )
+        # also copy for archiving & debugging purposes
+        shutil.copy(
+            str(DOWNLOAD_PATH.resolve()),
+            str(ARCHIVE_PATH.resolve())
+        )
+
+    fetcher.commit()
+    posts.save()
+    digests.save()
 
-    return
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":
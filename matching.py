@@ -0,0 +1,682 @@
+import re
+import threading
+import unicodedata
+from array import array
+from collections import Counter, defaultdict, deque
+from functools import cached_property
+from operator import sub
+from time import perf_counter
+
+from utils import config, normalize_for_match
+
+
+# set constants
+# -------------
+
+# characters that separate tokens besides spaces
+SEPARATORS = "\n\xa0,;:"
+# characters stripped from the end of a token, ie. Jezera. > Jezera
+TRAILING = ".-–"
+# settlement names within this many edits of a tag also match, ie.
+# misspelled or in an unexpected declension; 0 turns fuzzy matching off
+MATCH_FUZZY_DISTANCE = config.getint('MATCHING', 'FuzzyDistance', fallback=0)
+# edits precomputed in fuzzy indexes, the most `FuzzyDistance` may use
+FUZZY_MAX_DISTANCE = 2
+# a tag allows one edit per this many characters, so short names such as
+# Ist or Vir only match exactly
+FUZZY_CHARS_PER_EDIT = 5
+# fuzzy lookups remembered by each settlement index, since notices
+# repeat the same words
+FUZZY_CACHE_SIZE = 100000
+
+
+# documents
+# ---------
+
+class Document:
+    """
+    A field of an entry, normalized and tokenized once for all the units
+    and tags matched against it; each form is computed on first use.
+
+    - Input:
+    text: the field's text
+    separators: characters replaced by spaces before splitting into tokens
+
+    - Attributes:
+    lower: the lowercased text
+    normalized: the lowercased text in `normalize_for_match` form
+    words: set of words of the NFKC normalized, lowercased text split
+    by spaces, ie. to find unit numbers
+    spaced: the stripped text with separators replaced by spaces
+    token_list: the non-empty, stripped tokens of `spaced` in order
+    tokens: set of the tokens
+    stripped_token_list: the tokens without a trailing `.`, `-` or `–`
+    stripped_tokens: set of the stripped tokens
+    """
+    def __init__(self, text, separators=SEPARATORS):
+        self.text = text
+        self.separators = separators
+
+    @cached_property
+    def lower(self):
+        return self.text.lower()
+
+    @cached_property
+    def normalized(self):
+        return normalize_for_match(self.lower)
+
+    @cached_property
+    def words(self):
+        # &nbsp; turns into \xa0 when splitting and
+        # slavic alphabet characters are not parsed correctly,
+        # so we normalize first
+        return set(unicodedata.normalize("NFKC", self.lower).split(" "))
+
+    @cached_property
+    def spaced(self):
+        return self.text.strip().translate(
+            {ord(char): " " for char in self.separators}
+        )
+
+    @cached_property
+    def token_list(self):
+        return [
+            item.strip() for item in self.spaced.split(" ") if item.strip()
+        ]
+
+    @cached_property
+    def tokens(self):
+        return set(self.token_list)
+
+    @cached_property
+    def stripped_token_list(self):
+        return [
+            item[:-1] if item[-1:] in TRAILING else item
+            for item in self.token_list
+        ]
+
+    @cached_property
+    def stripped_tokens(self):
+        return set(self.stripped_token_list)
+
+
+# tags
+# ----
+
+def capitalize_tag(tag):
+    """
+    Capitalizes each word of a tag as in notices, ie. m.iž > M.Iž,
+    staroj novalji > Staroj Novalji.
+    """
+    return re.sub(r'(\b[a-z])', lambda m: m.group(1).upper(), tag)
+
+
+# matching
+# --------
+
+class TagMatcher:
+    """
+    Aho–Corasick automaton over many tags, which finds the values of
+    the tags occurring in a text in a single pass over the text, instead
+    of a substring search per tag.
+
+    - Input:
+    tags: (tag, value) pairs, ie. from `bundle.get_unit_tags(unit_ids)`
+    normalize: function applied to tags and texts before matching; by
+    default `normalize_for_match`, so a tag matches spelling variants
+    of itself, ie. other dashes; None matches them as they are
+    values: what the values are IDs of in the bundle, "units" or
+    "settlements", to name them in the match profile
+
+    - Attributes:
+    name: the source and key of the matcher, set by the bundle
+    tags: (tag, value) pairs as matched, for the match profile
+
+    - Usage:
+    matcher = TagMatcher(bundle.get_unit_tags(unit_ids))
+    matcher.match(field.lower())  # {3, 17}
+    matcher.match_document(Document(field))  # the same
+    """
+    def __init__(self, tags, normalize=normalize_for_match, values="units"):
+        # kept as given, so compiled matchers can be pickled
+        self.normalize = normalize
+        self.values = values
+        self.name = None
+        self.tags = [
+            (self.normalize(tag) if normalize else tag, value)
+            for tag, value in tags
+        ]
+
+        # trie of the normalized tags; state 0 is the root
+        self.goto = [dict()]
+        self.outputs = [set()]
+        for tag, value in self.tags:
+            state = 0
+            for char in tag:
+                if char not in self.goto[state]:
+                    self.goto.append(dict())
+                    self.outputs.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state].add(value)
+
+        # failure links, breadth first, each state also reporting
+        # the tags that end in its longest proper suffix
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+
+    def match(self, text):
+        """
+        Returns values of the tags occurring in `text`.
+        """
+        return self.scan(self.normalize(text) if self.normalize else text)
+
+    def match_document(self, document):
+        """
+        Same as `match` for a Document's lowercased text, reusing its
+        normalized form.
+        """
+        if self.normalize is normalize_for_match:
+            return self.scan(document.normalized)
+        return self.match(document.lower)
+
+    def scan(self, text):
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+
+        # an empty tag occurs in every text
+        matched = set(outputs[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                matched |= outputs[state]
+
+        if PROFILE.enabled:
+            PROFILE.evaluate(
+                self.name, "automaton", self.values, self.tags,
+                text.__contains__
+            )
+        return matched
+
+
+class SettlementIndex:
+    """
+    Inverted index of settlement tags: each looked up form of a tag,
+    mapped to the settlements it names. A document's
+    tokens and n-grams of consecutive tokens are then resolved with
+    a hash lookup each, instead of comparing every tag of every
+    settlement of every island.
+
+    - Input:
+    tags: (tag, settlement ID) pairs, from `bundle.get_settlement_tags`
+    forms: functions giving the forms of a tag as they appear in
+    documents, ie. (capitalize_tag, str.upper)
+
+    - Attributes:
+    name: the source and key of the index, set by the bundle
+
+    - Usage:
+    index = SettlementIndex(
+        bundle.get_settlement_tags(['pag']), forms=(capitalize_tag,)
+    )
+    index.lookup(Document(body).stripped_token_list)
+    # {412: {'Novalja'}}
+    """
+    def __init__(self, tags, forms=(str,)):
+        tags = list(tags)
+        self.forms = forms
+        self.name = None
+        self.index = defaultdict(set)
+        # number of tokens of the longest form
+        self.max_words = 1
+        for tag, settlement in tags:
+            for form in forms:
+                key = form(tag)
+                self.index[key].add(settlement)
+                self.max_words = max(self.max_words, len(key.split(" ")))
+        self.fuzzy = FuzzyIndex(tags)
+        # fuzzy hits by n-gram and distance
+        self.fuzzy_cache = dict()
+        # words of tags of several words; only n-grams with one of them
+        # are looked up fuzzily, since a few edits rarely touch every word
+        self.fuzzy_words = set(
+            word for tag, _ in tags if " " in tag
+            for word in tag.casefold().split(" ")
+        )
+
+    def get(self, key):
+        """
+        Returns settlement IDs named exactly by `key`.
+        """
+        if PROFILE.enabled:
+            PROFILE.evaluate(
+                self.name, "index", "settlements", self.get_keys(),
+                key.__eq__
+            )
+        return self.index.get(key, set())
+
+    def get_keys(self):
+        """
+        Yields (form, settlement ID) pairs of the index.
+        """
+        for key, settlements in self.index.items():
+            for settlement in settlements:
+                yield key, settlement
+
+    def lookup(self, tokens):
+        """
+        Returns the settlement IDs named by tokens or n-grams of
+        consecutive tokens, with the forms that named them.
+
+        - Input:
+        tokens: list of a document's tokens in order
+        """
+        found = defaultdict(set)
+        for n in range(1, self.max_words + 1):
+            for i in range(len(tokens) - n + 1):
+                key = " ".join(tokens[i:i + n])
+                for settlement in self.index.get(key, ()):
+                    found[settlement].add(key)
+
+        if PROFILE.enabled:
+            ngrams = set(
+                " ".join(tokens[i:i + n])
+                for n in range(1, self.max_words + 1)
+                for i in range(len(tokens) - n + 1)
+            )
+            PROFILE.evaluate(
+                self.name, "index", "settlements", self.get_keys(),
+                ngrams.__contains__
+            )
+        return found
+
+    def lookup_fuzzy(self, tokens, distance=MATCH_FUZZY_DISTANCE, exclude=()):
+        """
+        Returns the settlement IDs named by tokens or n-grams of
+        consecutive tokens within `distance` edits of a tag, with
+        (n-gram, tag, edits) of each fuzzy hit. Only n-grams written in
+        one of the index's forms are looked up, ie. capitalized, so
+        common words aren't taken for names, and n-grams of several
+        tokens only with a word of a tag of several words.
+
+        - Input:
+        tokens: list of a document's tokens in order
+        distance: maximum edits, by default `FuzzyDistance` of the config
+        exclude: settlement IDs to skip, ie. exact hits of `lookup`
+        """
+        found = defaultdict(set)
+        if not distance:
+            return found
+
+        known = [token.casefold() in self.fuzzy_words for token in tokens]
+        for n in range(1, self.max_words + 1):
+            for i in range(len(tokens) - n + 1):
+                if n > 1 and not any(known[i:i + n]):
+                    continue
+                key = " ".join(tokens[i:i + n])
+                if key in self.index:
+                    continue
+                hits = self.fuzzy_cache.get((key, distance))
+                if hits is None:
+                    hits = self.get_fuzzy_hits(key, distance)
+                for settlement, hit in hits:
+                    if settlement not in exclude:
+                        found[settlement].add(hit)
+        return found
+
+    def get_fuzzy_hits(self, key, distance):
+        """
+        Returns (settlement ID, (key, tag, edits)) hits of an n-gram,
+        remembered for the next lookups.
+        """
+        hits = []
+        folded = key.casefold()
+        if any(form(folded) == key for form in self.forms):
+            for tag, edits in self.fuzzy.lookup(key, distance).items():
+                for settlement in self.fuzzy.values[tag]:
+                    hits.append((settlement, (key, tag, edits)))
+
+        if len(self.fuzzy_cache) >= FUZZY_CACHE_SIZE:
+            self.fuzzy_cache.clear()
+        self.fuzzy_cache[(key, distance)] = hits
+        return hits
+
+
+# fuzzy matching
+# --------------
+
+def get_edit_distance(a, b, max_distance):
+    """
+    Returns the Levenshtein distance of two strings, or
+    `max_distance + 1` as soon as it's known to be larger.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def get_deletes(text, distance):
+    """
+    Returns the strings made by deleting up to `distance` characters
+    of `text`, including `text` itself.
+    """
+    deletes = {text}
+    edge = {text}
+    for _ in range(distance):
+        edge = set(s[:i] + s[i + 1:] for s in edge for i in range(len(s)))
+        deletes |= edge
+    return deletes
+
+
+def get_max_edits(tag, max_distance):
+    return min(max_distance, len(tag) // FUZZY_CHARS_PER_EDIT)
+
+
+def format_fuzzy_hits(hits):
+    """
+    Formats (text, tag, edits) hits of `lookup_fuzzy` for the log,
+    ie. Novalji~novalja(1).
+    """
+    return ",".join(
+        f"{text}~{tag}({edits})" for text, tag, edits in sorted(hits)
+    )
+
+
+class FuzzyIndex:
+    """
+    Symmetric deletion index of tags in `normalize_for_match` form: each
+    tag is stored under the strings made by deleting up to its allowed
+    edits of characters, so the tags within a distance of a text are
+    found by looking up the text's own deletions and verifying their
+    edit distance, instead of comparing the text with every tag.
+
+    - Input:
+    tags: (tag, value) pairs
+    max_distance: most edits a lookup may allow
+
+    - Attributes:
+    values: values by normalized tag
+    name: the source and key of the index, set by the bundle; values
+    are then settlement IDs
+    """
+    def __init__(self, tags, max_distance=FUZZY_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.name = None
+        self.values = defaultdict(set)
+        self.deletes = defaultdict(set)
+        self.max_length = 0
+        for tag, value in tags:
+            normalized = normalize_for_match(tag)
+            self.values[normalized].add(value)
+            self.max_length = max(self.max_length, len(normalized))
+            edits = get_max_edits(normalized, max_distance)
+            for delete in get_deletes(normalized, edits):
+                self.deletes[delete].add(normalized)
+
+    def lookup(self, text, distance):
+        """
+        Returns edits of the normalized tags within `distance` edits of
+        the text, each also within the edits its length allows.
+        """
+        text = normalize_for_match(text)
+        # a tag within `edits` is at least `edits * FUZZY_CHARS_PER_EDIT`
+        # long, so the text is at least `edits` shorter than that
+        distance = min(
+            distance, self.max_distance,
+            len(text) // (FUZZY_CHARS_PER_EDIT - 1)
+        )
+        if not distance or len(text) - distance > self.max_length:
+            return dict()
+
+        found = dict()
+        for delete in get_deletes(text, distance):
+            for tag in self.deletes.get(delete, ()):
+                if tag in found:
+                    continue
+                started = perf_counter()
+                max_edits = get_max_edits(tag, distance)
+                found[tag] = get_edit_distance(text, tag, max_edits)
+                if found[tag] > max_edits:
+                    found[tag] = None
+                if PROFILE.enabled:
+                    PROFILE.add(
+                        ((self.name, "fuzzy", "settlements", value, tag),
+                         found[tag] is not None, perf_counter() - started)
+                        for value in self.values[tag]
+                    )
+        return {
+            tag: edits for tag, edits in found.items() if edits is not None
+        }
+
+
+# batch matching
+# --------------
+
+def match_units(fields, matcher, names=None):
+    """
+    Returns IDs of the units a document mentions in any of its fields.
+
+    - Input:
+    fields: texts or Documents of the document's fields, each matched
+    on its own, ie. title, subtitle and body
+    matcher: TagMatcher of unit tags to unit IDs
+    names: optional unit IDs by unit name, for units also found by
+    their name as a separate word, ie. line numbers
+    """
+    matched = set()
+    for field in fields:
+        document = field if isinstance(field, Document) else Document(field)
+        if names:
+            for name in document.words & names.keys():
+                matched |= names[name]
+        matched |= matcher.match_document(document)
+    return matched
+
+
+class HitMatrix:
+    """
+    Sparse matrix of documents × units, with a hit where a document
+    mentions a unit, in compressed sparse row form: the unit IDs of all
+    hits in one array, ordered by document, and each document's offset
+    into it in another.
+
+    - Input:
+    unit_count: number of columns, ie. len(bundle.units)
+
+    - Attributes:
+    indptr: offsets of documents' hits in `indices`, one per document
+    and one past the last
+    indices: unit IDs of the hits, ascending within a document
+    """
+    def __init__(self, unit_count):
+        self.unit_count = unit_count
+        self.indptr = array("l", [0])
+        self.indices = array("l")
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self):
+        return len(self), self.unit_count
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def append(self, unit_ids):
+        """
+        Adds a row with hits of a document's units.
+        """
+        self.indices.extend(sorted(unit_ids))
+        self.indptr.append(len(self.indices))
+
+    def get_units(self, document):
+        """
+        Returns unit IDs a document mentions.
+        """
+        return self.indices[self.indptr[document]:self.indptr[document + 1]]
+
+    def get_documents(self, unit_id):
+        """
+        Returns indexes of the documents mentioning a unit.
+        """
+        return [
+            document for document in range(len(self))
+            if unit_id in self.get_units(document)
+        ]
+
+    def hits_per_unit(self):
+        """
+        Returns numbers of documents mentioning each unit, by unit ID.
+        """
+        counts = array("l", [0]) * self.unit_count
+        for unit_id, count in Counter(self.indices).items():
+            counts[unit_id] = count
+        return counts
+
+    def hits_per_document(self):
+        """
+        Returns numbers of units each document mentions.
+        """
+        return array("l", map(sub, self.indptr[1:], self.indptr[:-1]))
+
+
+def match_batch(documents, matcher, unit_count, names=None):
+    """
+    Matches many documents at once, ie. archived notices after tags
+    changed, and returns their hits as a HitMatrix with a row for each
+    document, in order.
+
+    - Input:
+    documents: lists of each document's fields, as in `match_units`
+    matcher, names: as in `match_units`
+    unit_count: number of units, ie. len(bundle.units)
+
+    - Usage:
+    bundle = load_bundle()
+    unit_ids = bundle.get_unit_ids("jadrolinija/infrastructure.json")
+    matrix = match_batch(
+        [[e["title"], e["subtitle"], e["body"]] for e in entries],
+        bundle.matching["jadrolinija"],
+        len(bundle.units),
+        names=bundle.get_unit_name_ids(unit_ids)
+    )
+    matrix.hits_per_unit()  # array('l', [0, 12, 3, ...])
+    bundle.hits_per_island(matrix)  # {'cres': 15, ...}
+    """
+    matrix = HitMatrix(unit_count)
+    for fields in documents:
+        matrix.append(match_units(fields, matcher, names))
+    return matrix
+
+
+# profiling
+# ---------
+
+class MatchProfile:
+    """
+    Evaluations, hits and cumulative time of each tag, by matcher and
+    value, recorded while `enabled`, ie. with `bodulica run --profile`.
+
+    The automata and indexes find all their tags at once, so while
+    profiling each tag is also evaluated on its own, with the same
+    semantics, to attribute hits and time to it: a substring search in
+    an automaton's text and a lookup among a document's n-grams in a
+    settlement index. Fuzzy verifications are timed as they are made.
+    Profiling thus slows matching down and is meant for pruning tags
+    that never match and spotting costly ones, not for regular runs.
+
+    - Attributes:
+    stats: [evaluations, hits, seconds] by (matcher name, matcher kind,
+    what values are IDs of, value, tag)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stats = defaultdict(lambda: [0, 0, 0.0])
+        self.lock = threading.Lock()
+
+    def add(self, records):
+        """
+        Adds (key, hit, seconds) records of tag evaluations.
+        """
+        with self.lock:
+            for key, hit, seconds in records:
+                stats = self.stats[key]
+                stats[0] += 1
+                stats[1] += hit
+                stats[2] += seconds
+
+    def evaluate(self, name, kind, values, tags, check):
+        """
+        Evaluates each of the (tag, value) pairs with `check(tag)`, timed,
+        and records it.
+        """
+        records = []
+        for tag, value in tags:
+            started = perf_counter()
+            hit = check(tag)
+            records.append(
+                ((name, kind, values, value, tag), hit,
+                 perf_counter() - started)
+            )
+        self.add(records)
+
+    def get_rows(self, describe):
+        """
+        Returns (matcher name, matcher kind, value, tag, evaluations, hits,
+        seconds) rows, the most costly tags first.
+
+        - Input:
+        describe: function naming a value, given what it's an ID of and
+        the ID, ie. `bundle.describe`
+        """
+        with self.lock:
+            stats = list(self.stats.items())
+        rows = [
+            (name or "-", kind, describe(values, value), tag, *stats)
+            for (name, kind, values, value, tag), stats in stats
+        ]
+        return sorted(rows, key=lambda row: (-row[6], row[:4]))
+
+
+def format_profile(rows):
+    """
+    Formats rows of `MatchProfile.get_rows` as a table.
+    """
+    lines = [
+        f"{'matcher':<28}{'kind':<11}{'unit':<32}{'tag':<28}"
+        f"{'evaluations':>12}{'hits':>8}{'time':>12}"
+    ]
+    for name, kind, value, tag, evaluations, hits, seconds in rows:
+        lines.append(
+            f"{name:<28}{kind:<11}{value:<32}{tag!r:<28}"
+            f"{evaluations:>12}{hits:>8}{seconds * 1000:>10.3f}ms"
+        )
+    return lines
+
+
+PROFILE = MatchProfile()
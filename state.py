@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+
+# set constants
+# -------------
+
+# checkpoints older than this are stale and discarded, in seconds
+CHECKPOINT_MAX_AGE = 6 * 60 * 60
+
+
+# persistence
+# -----------
+
+def load_state(path, default):
+    """
+    Loads a JSON state file, or returns `default` if it doesn't exist yet.
+    """
+    path = Path(path)
+    if not path.exists():
+        return default
+    with open(path.resolve(), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path, data):
+    """
+    Writes a JSON state file atomically, so a killed run never leaves
+    a truncated file behind.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path.resolve(), "w+", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def get_fingerprint(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# seen links
+# ----------
+
+class SeenLinks:
+    """
+    Persisted index of listing links whose subpages were already processed,
+    with a fingerprint of each link's listing text to notice edited notices.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.links = load_state(self.path, dict())
+        self.fingerprints = dict()
+        self.listed = set()
+
+    def filter(self, listing, stop_at_first_seen=False):
+        """
+        Returns listing links that weren't seen or whose listing text changed.
+
+        - Input:
+        listing: list of (link, text) tuples, newest first; a link listed
+        more than once is fingerprinted by all of its texts
+        stop_at_first_seen: stop at the first unchanged link, since older
+        links below it were processed on previous runs
+        """
+        texts = dict()
+        for link, text in listing:
+            texts[link] = f"{texts.get(link, '')}|{text.strip()}"
+        self.fingerprints = {
+            link: get_fingerprint(text) for link, text in texts.items()
+        }
+        self.listed = set(texts)
+
+        links = []
+        for link, fingerprint in self.fingerprints.items():
+            if self.links.get(link) == fingerprint:
+                if stop_at_first_seen:
+                    break
+                continue
+            links.append(link)
+        return links
+
+    def add(self, link):
+        self.links[link] = self.fingerprints.get(link, '')
+
+    def save(self):
+        # forget links which dropped off the listing
+        if self.listed:
+            self.links = {
+                link: fingerprint for link, fingerprint in self.links.items()
+                if link in self.listed
+            }
+        save_state(self.path, self.links)
+
+
+# fingerprints
+# ------------
+
+class Fingerprints:
+    """
+    Persisted content fingerprints by key, to skip processing content
+    that didn't change since the last run.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fingerprints = load_state(self.path, dict())
+        self.pending = dict()
+
+    def changed(self, key, fingerprint):
+        """
+        Returns whether the content under `key` changed since the last run.
+        """
+        self.pending[key] = fingerprint
+        return self.fingerprints.get(key) != fingerprint
+
+    def save(self, keep=None):
+        """
+        Persists this run's fingerprints; `keep` optionally filters out
+        expired keys.
+        """
+        self.fingerprints.update(self.pending)
+        self.pending = dict()
+        if keep:
+            self.fingerprints = {
+                key: fingerprint
+                for key, fingerprint in self.fingerprints.items()
+                if keep(key)
+            }
+        save_state(self.path, self.fingerprints)
+
+
+# checkpoints
+# -----------
+
+class Checkpoint:
+    """
+    Persisted progress of an unfinished crawl: URLs already processed and
+    the entries extracted from them, so a failed or killed run resumes
+    where it stopped and only downloads the missing URLs.
+    """
+    def __init__(self, path, max_age=CHECKPOINT_MAX_AGE):
+        self.path = Path(path)
+        state = load_state(self.path, dict())
+        if time.time() - state.get("created_at", 0) > max_age:
+            state = dict()
+        self.created_at = state.get("created_at", time.time())
+        self.done = state.get("done", dict())
+
+    def restore(self, urls):
+        """
+        Yields (url, entries) pairs of URLs processed by a previous run.
+        """
+        for url in urls:
+            if url in self.done:
+                yield url, self.done[url]
+
+    def pending(self, urls):
+        """
+        Returns URLs which weren't processed yet.
+        """
+        return [url for url in urls if url not in self.done]
+
+    def add(self, url, entries):
+        """
+        Marks a URL processed with the entries extracted from it,
+        persisting the progress right away.
+        """
+        self.done[url] = entries
+        save_state(
+            self.path, {"created_at": self.created_at, "done": self.done}
+        )
+
+    def finish(self, failed):
+        """
+        Discards the checkpoint once a run downloaded every URL; otherwise
+        keeps it, so the next run retries only the failed URLs.
+        """
+        if not failed:
+            self.path.unlink(missing_ok=True)
@@ -1,12 +1,18 @@
 import configparser
+import heapq
+import itertools
 import json
+import logging
 import re
+import threading
 import time
-from urllib.request import Request, urlopen
 
 from babel.dates import format_datetime
+from bs4 import SoupStrainer
 from dateutil import parser
 
+from fetching import send_request
+
 
 # constants
 # ---------
@@ -18,6 +24,11 @@ _dash_re = re.compile(f"[{re.escape(DASHES)}]")
 _ws_re = re.compile(r"\s+")
 _space_around_dash_re = re.compile(r"\s*-\s*")
 
+# source and unit priorities; lower is more urgent
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 
 # load configuration
 # ------------------
@@ -33,9 +44,79 @@ MAIL_SENDER_EMAIL = mailing_config.get('MailSenderEmail')
 MAIL_SENDER_NAME = mailing_config.get('MailSenderName')
 
 
+# logging
+# -------
+
+_stdout_stream = None
+_stdout_lock = threading.Lock()
+
+
+def get_stdout_stream():
+    """
+    Returns a line-buffered UTF-8 stream on fd 1, shared by all sources
+    running in the same process.
+    """
+    global _stdout_stream
+    with _stdout_lock:
+        if _stdout_stream is None:
+            _stdout_stream = open(
+                1, 'w', encoding="utf-8", buffering=1, closefd=False
+            )
+        return _stdout_stream
+
+
+def setup_logging(logger, log_path, job_id):
+    """
+    Attaches stdout and log file handlers to a source's logger.
+
+    Called when a source runs rather than when it's imported, so sources
+    can be imported side-effect free; calling it again only switches
+    the logged job ID, ie. for the next run in daemon mode.
+    """
+    formatter = logging.Formatter(
+        f"%(asctime)s | %(levelname)s | {job_id} | %(message)s"
+    )
+    # sources running in the same process share stdout, so its lines
+    # also name the source
+    stdout_formatter = logging.Formatter(
+        f"%(asctime)s | %(levelname)s | %(name)s | {job_id} | %(message)s"
+    )
+    if logger.handlers:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.FileHandler):
+                handler.setFormatter(formatter)
+            else:
+                handler.setFormatter(stdout_formatter)
+        return logger
+
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    stdout_handler = logging.StreamHandler(get_stdout_stream())
+    stdout_handler.setLevel(logging.DEBUG)
+    stdout_handler.setFormatter(stdout_formatter)
+
+    log_file_handler = logging.FileHandler(
+        str(log_path.resolve()), encoding="utf-8"
+    )
+    log_file_handler.setLevel(logging.DEBUG)
+    log_file_handler.setFormatter(formatter)
+
+    logger.addHandler(log_file_handler)
+    logger.addHandler(stdout_handler)
+    return logger
+
+
 # mailing
 # -------
 
+# (priority, order) tickets of emails waiting to be sent
+_mail_queue = []
+_mail_order = itertools.count()
+_mail_sending = False
+_mail_condition = threading.Condition()
+
+
 def construct_request_payload(emails, subject, body):
     payload = dict()
 
@@ -62,20 +143,43 @@ def construct_request_payload(emails, subject, body):
     return payload
 
 
-def send_email(emails, subject, body):
+def send_email(emails, subject, body, priority=PRIORITY_NORMAL):
     """
     Sends emails via the Brevo service (formerly SendInBlue).
 
+    Emails of all sources running in the same process are sent one at
+    a time, the most urgent `priority` first, so ie. ferry cancellations
+    don't wait behind a long batch of power outages.
+
     https://www.brevo.com
     """
+    global _mail_sending
     if MAIL_ENABLED:
         payload = construct_request_payload(emails, subject, body)
         data = str(json.dumps(payload)).encode('utf-8')
-        request = Request(f'{MAIL_API_URL}', data=data, method='POST')
-        request.add_header('api-key', MAIL_API_TOKEN)
-        request.add_header('Content-Type', 'application/json')
-        time.sleep(0.5)
-        urlopen(request)
+        headers = {
+            'api-key': MAIL_API_TOKEN,
+            'Content-Type': 'application/json',
+        }
+
+        # wait for this email's turn
+        ticket = (priority, next(_mail_order))
+        with _mail_condition:
+            heapq.heappush(_mail_queue, ticket)
+            _mail_condition.wait_for(
+                lambda: not _mail_sending and _mail_queue[0] == ticket
+            )
+            heapq.heappop(_mail_queue)
+            _mail_sending = True
+
+        try:
+            time.sleep(0.5)
+            # reuses the pooled keep-alive connection to the mailing API
+            send_request(f'{MAIL_API_URL}', headers, data=data, method='POST')
+        finally:
+            with _mail_condition:
+                _mail_sending = False
+                _mail_condition.notify_all()
 
 
 def get_email_footer():
@@ -84,6 +188,42 @@ def get_email_footer():
         'https://skoljarev.com/bodulica/</a>'
 
 
+# parsing
+# -------
+
+def get_strainer(*selectors):
+    """
+    Returns a SoupStrainer that builds only the subtrees a scraper needs.
+
+    - Input:
+    selectors: (tag name, attributes) tuples, where a class matches
+    any of the tag's classes and other attributes match exactly, ie.
+    ('div', {'class': 'radwrap'}), ('h1', {})
+
+    - Usage:
+    BeautifulSoup(response, 'html.parser', parse_only=strainer)
+    """
+    def match(name, attrs):
+        attrs = dict(attrs or {})
+        for selector_name, selector_attrs in selectors:
+            if name != selector_name:
+                continue
+            for key, value in selector_attrs.items():
+                attr_value = attrs.get(key) or ''
+                if isinstance(attr_value, list):
+                    attr_value = ' '.join(attr_value)
+                if key == 'class':
+                    if value not in attr_value.split():
+                        break
+                elif attr_value != value:
+                    break
+            else:
+                return True
+        return False
+
+    return SoupStrainer(match)
+
+
 # string utils
 # ------------
 
@@ -104,46 +244,9 @@ def normalize_for_match(s: str) -> str:
     return s.casefold()
 
 
-def contains_variant(text: str, canonical: str) -> bool:
-    return normalize_for_match(canonical) in normalize_for_match(text)
-
-
 # misc
 # ----
 
 def get_weekday_in_lang(date_str, lang):
     dt = parser.parse(date_str, dayfirst=True)
     return format_datetime(dt, "EEEE", locale=lang)
-
-
-def get_settlement_names_and_tags(islands, island_name):
-    """
-    Returns list of settlement names and tags for an island name as an input.
-
-    - Input:
-    islands: list of dictionaries
-    island_name: 'ugljan'
-
-    - Output:
-    [{'name': 'ugljan', 'tags': 'ugljan'},
-    {'name': 'lukoran', 'tags': 'lukoran'},
-    {'name': 'sutomiscica', 'tags': 'sutomišćica'},
-    {'name': 'poljana', 'tags': 'poljana'},
-    {'name': 'preko', 'tags': 'preko'},
-    {'name': 'kali', 'tags': 'kali'},
-    {'name': 'kukljica', 'tags': 'kukljica'}]
-    """
-    # process
-    island = next((item for item in islands if item['name'] == island_name), None)
-    if island:
-        settlements = island.get('settlements', [])
-        if settlements:
-            results = []
-            for settlement in settlements:
-                result = {
-                    "name": settlement.get('name'),
-                    "tags": settlement.get('tags'),
-                }
-                results.append(result)
-            return results
-    return []
\ No newline at end of file
@@ -1,20 +1,28 @@
 import json
 import logging
 import random
-import re
 import shutil
 import string
-import sys
 from datetime import datetime
 from pathlib import Path
-from urllib.request import Request, urlopen
 
 from bs4 import BeautifulSoup
 
+from bundle import load_bundle
+from fetching import Fetcher
+from matching import (
+    Document,
+    SettlementIndex,
+    capitalize_tag,
+    format_fuzzy_hits,
+)
+from state import Fingerprints, get_fingerprint
 from utils import (
+    PRIORITY_NORMAL,
     get_email_footer,
-    get_settlement_names_and_tags,
+    get_strainer,
     send_email,
+    setup_logging,
 )
 
 
@@ -25,6 +33,11 @@ COMPANY_NAME = "Vodovod Zadar"
 SCRIPT_NAME = "vodovod_zadar"
 JOB_ID = "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
 NOW = datetime.now().strftime("%Y%m%d_%H%M%S")
+# urgency of the source's runs in daemon mode and of its emails
+PRIORITY = PRIORITY_NORMAL
+# polling interval bounds in daemon mode, in seconds
+POLL_INTERVAL_MIN = 30 * 60
+POLL_INTERVAL_MAX = 12 * 60 * 60
 SOURCE_URLS = [
     'https://www.vodovod-zadar.hr/obavijesti',
     # 'https://www.vodovod-zadar.hr/novosti',
@@ -35,35 +48,38 @@ INFRASTRUCTURE_PATH = Path(f"{SCRIPT_NAME}/infrastructure.json")
 RESULTS_PATH = Path(f"{SCRIPT_NAME}/results.log")
 DOWNLOAD_PATH = Path(f"{SCRIPT_NAME}/data/page.html")
 ARCHIVE_PATH = Path(f"{SCRIPT_NAME}/data/page_{NOW}_{JOB_ID}.html")
+HTTP_CACHE_PATH = Path(f"{SCRIPT_NAME}/data/http_cache.json")
+DIGESTS_PATH = Path(f"{SCRIPT_NAME}/data/digests.json")
 LOG_PATH = Path(f"{SCRIPT_NAME}/processing.log")
 EMAIL_FOOTER = get_email_footer()
+# subtrees of the source pages the scraper reads
+PARSE_ONLY = get_strainer(('div', {'class': 'news-news-list'}))
 
 
 # setup logging
 # -------------
 
-logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    f"%(asctime)s | %(levelname)s | {JOB_ID} | %(message)s"
-)
-
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setLevel(logging.DEBUG)
-stdout_handler.setFormatter(formatter)
-stdout_handler.stream = open(1, 'w', encoding="utf-8", buffering=1)
-
-log_file_handler = logging.FileHandler(str(LOG_PATH.resolve()), encoding="utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(formatter)
-
-logger.addHandler(log_file_handler)
-logger.addHandler(stdout_handler)
+logger = logging.getLogger(SCRIPT_NAME)
 
 
 # processing
 # ----------
 
+def compile_matching(bundle):
+    """
+    Returns the source's settlement index, compiled with the bundle.
+    """
+    units = bundle.get_units(INFRASTRUCTURE_PATH)
+
+    # index settlements of the islands connected to the singular
+    # company unit by their capitalized tags,
+    # for ex. m.iž > M.Iž, staroj novalji > Staroj Novalji
+    return SettlementIndex(
+        bundle.get_settlement_tags(units[0].get('islands')),
+        forms=(capitalize_tag,)
+    )
+
+
 def process():
     # prepare headers
     headers = {
@@ -72,31 +88,32 @@ def process():
                       'Chrome/107.0.0.0 Safari/537.36'
     }
 
+    fetcher = Fetcher(logger, headers, cache_path=HTTP_CACHE_PATH)
+
     # download the page
     try:
-        request = Request(SOURCE_URLS[0])
-        for key, value in headers.items(): 
-            request.add_header(key, value)
-        response = urlopen(request).read()
+        response = fetcher.fetch(SOURCE_URLS[0])
     except:
         logger.error(f"Error downloading data")
-        return
+        fetcher.fail(SOURCE_URLS[0])
+        return []
 
-    # create a download file it doesn't exist
-    if not DOWNLOAD_PATH.exists():
-        f = DOWNLOAD_PATH.open("wb+")
-        f.close()
+    # the page wasn't modified since the last run
+    if response is None:
+        fetcher.commit()
+        return []
 
-    # check if new data available
-    f = DOWNLOAD_PATH.open("rb")
-    existing_data = f.read()
-    f.close()
-    if existing_data == response:
-        return
+    # check if new data available by the page's digest
+    digests = Fingerprints(DIGESTS_PATH)
+    if not digests.changed(SOURCE_URLS[0], fetcher.digests[SOURCE_URLS[0]]):
+        fetcher.commit()
+        return []
 
     # scrape the response & collect entries
     entries = []
-    soup = BeautifulSoup(response, 'html.parser')
+    soup = BeautifulSoup(
+        response, 'html.parser', parse_only=PARSE_ONLY
+    )
     divs = soup.find_all('div', class_='news-news-list')
     for div in divs:
         published_at = div.find('time').text
@@ -118,10 +135,14 @@ def process():
         }
         entries.append(entry)
 
-    # load infrastructure data
-    with open(INFRASTRUCTURE_PATH.resolve(), "rb") as f:
-        infrastructure = json.load(f)
-        units = infrastructure.get("units")
+    # changed notices, rather than the page's bytes, adapt polling in
+    # daemon mode
+    fetcher.add_changes(
+        digests.changed("entries", get_fingerprint(json.dumps(entries)))
+    )
+
+    # load compiled infrastructure, island & contact data
+    bundle = load_bundle()
 
     # create a results file it doesn't exist
     if not RESULTS_PATH.exists():
@@ -132,77 +153,53 @@ def process():
     with open(str(RESULTS_PATH.resolve())) as f:
         results = f.read()
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands_all = json.load(f)
+    # settlements indexed by their tags, compiled with the bundle
+    index = bundle.matching[SCRIPT_NAME]
 
     # process entries
     new_results = []
     for entry in entries:
-        body_raw = entry.get("body").strip().replace(
-            '\n', ' '
-        ).replace(
-            '\xa0', ' '
-        ).replace(
-            ',', ' '
-        ).replace(
-            ';', ' '
-        ).replace(
-            ':', ' '
-        )
-        body = [
-            item.strip() for item in body_raw.split(' ') if item.strip()
-        ]
+        document = Document(entry.get("body"))
+        body_raw = document.spaced
         # check for last characters, for ex. Vir. > Vir
-        body = [item[:-1] if item[-1:] in ['.', '-', '–'] else item for item in body]
-        
-        # get islands connected to the singular company unit
-        unit = units[0]
-        islands = unit.get('islands')
-
-        # check if islands' settlements' tags in entry content
-        for island in islands:
-            # retrieve island's settlements
-            settlements = get_settlement_names_and_tags(islands_all, island)
-            for settlement in settlements:
-                # form a result
-                locality = settlement.get('name')
-                published_at = entry.get("published_at").strip()
-                title = entry.get("title").strip()
-                result = f"{published_at}|{title}|{body_raw}|{island}|{locality}"
-                # check tags
-                tags = settlement.get('tags').split(',')
-                for tag in tags:
-                    # capitalize the tag
-                    # for ex. m.iž > M.Iž, staroj novalji > Staroj Novalji
-                    capitalized_tag = re.sub(
-                        r'(\b[a-z])', lambda m: m.group(1).upper(), tag
-                    )
-                    # print(">", capitalized_tag)
-                    if capitalized_tag in body:
-                        # discard specific cases
-                        if capitalized_tag == 'Poljana':
-                            if 'Stojakovića' in body or 'Požarišće' in body or 'Pavlovića' in body:
-                                continue
-
-                        # check if result already exists
-                        if result not in results:
-                            new_results.append(result)
+        body = document.stripped_tokens
+        published_at = entry.get("published_at").strip()
+        title = entry.get("title").strip()
+
+        # check if islands' settlements' tags in entry content,
+        # in fuzzy mode also misspelled or otherwise declined
+        found = index.lookup(document.stripped_token_list)
+        fuzzy = index.lookup_fuzzy(document.stripped_token_list, exclude=found)
+        for settlement_id, hits in fuzzy.items():
+            island, locality = bundle.settlements[settlement_id]
+            logger.info(
+                f"[FUZZY HIT] {title}|{island}|{locality}|"
+                f"{format_fuzzy_hits(hits)}"
+            )
+            found[settlement_id] |= set(text for text, _, _ in hits)
+
+        for settlement_id, tags in found.items():
+            island, locality = bundle.settlements[settlement_id]
+            # discard specific cases
+            if 'Stojakovića' in body or 'Požarišće' in body or 'Pavlovića' in body:
+                tags = tags - {'Poljana'}
+            if not tags:
+                continue
+
+            # form a result
+            result = f"{published_at}|{title}|{body_raw}|{island}|{locality}"
+            # check if result already exists
+            if result not in results:
+                new_results.append(result)
 
     if not new_results:
-        return
+        fetcher.commit()
+        digests.save()
+        return []
 
     # remove duplicate new results
     new_results = list(set(new_results))
 
-    # load island data
-    with open("islands.json", "rb") as f:
-        islands = json.load(f)
-
-    # load contact data
-    with open("contacts.json", "rb") as f:
-        contacts = json.load(f)
-
     # construct email notifications
     emails = []
     for result in new_results:
@@ -216,13 +213,7 @@ def process():
             '</body></html>'.strip()
 
         # collect contacts' emails connected to this island
-        email_addresses = next(
-            (
-                item.get("contacts") for item in contacts \
-                    if item.get("island") == island_name
-            ),
-            []
-        )
+        email_addresses = list(bundle.contacts.get(island_name, ()))
         
         # log what is to be sent
         emails_str = ",".join(email_addresses) if email_addresses \
@@ -241,7 +232,7 @@ def process():
         email_addresses = email[0]
         subject = email[1]
         body = email[2]
-        send_email(email_addresses, subject, body)
+        send_email(email_addresses, subject, body, priority=PRIORITY)
 
     # write new results
     with open(RESULTS_PATH.resolve(), "a+", encoding="utf-8") as f:
@@ -259,14 +250,18 @@ def process():
         str(ARCHIVE_PATH.resolve())
     )
 
-    return
+    fetcher.commit()
+    digests.save()
+
+    return new_results
 
 
 # main
 # ----
 
 def main():
-    process()
+    setup_logging(logger, LOG_PATH, JOB_ID)
+    return process()
 
 
 if __name__ == "__main__":